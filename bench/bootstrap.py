@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+  Compares the latency of the two ways the bootstrapper has launched evolve:
+  system() through /bin/sh with a quoted command string, and execv() of the
+  interpreter with the argument vector unchanged (optionally with -E/-S).
+
+  The cold figure is the first invocation, after dropping the page cache
+  when running as root; the warm figures are over the remaining runs.
+'''
+
+__author__ = 'Will Leszczuk'
+
+import os, sys, time, tempfile, subprocess
+from optparse import OptionParser
+
+_PythonDir = \
+  os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python')
+_Module = 'evolve.cli.evolvecli'
+
+def _old_path(python, args):
+  # mirrors the command string the bootstrapper used to hand to system()
+  quoted = ' '.join('"%s"' % a.replace('"', '\\"') for a in args)
+  return ['/bin/sh', '-c', '%s -m %s %s' % (python, _Module, quoted)]
+
+def _new_path(python, flags, args):
+  return [python] + [f for f in [flags] if f] + ['-m', _Module] + args
+
+def _drop_caches():
+  if 0 != os.geteuid(): return False
+  subprocess.call(['sync'])
+  with open('/proc/sys/vm/drop_caches', 'w') as caches: caches.write('3\n')
+  return True
+
+def _time(argv, runs, cwd):
+  with open(os.devnull, 'w') as devnull:
+    def _run():
+      start = time.time()
+      # a launch that fails fast mustn't pass for a fast one
+      if 0 != subprocess.call(argv, cwd=cwd, stdout=devnull, stderr=devnull):
+        raise Exception('[%s] failed' % ' '.join(argv))
+      return time.time() - start
+
+    dropped = _drop_caches()
+    cold = _run()
+    warm = sorted(_run() for i in range(runs))
+  return dropped, cold, warm
+
+def _get_options():
+  parser = OptionParser(description=__doc__, usage='usage: %prog [OPTIONS]')
+  parser.add_option(
+    '-p', '--python', action='store', dest='python', default=sys.executable,
+    help='the interpreter to launch'
+  )
+  parser.add_option(
+    '-f', '--flags', action='store', dest='flags', default='-ES',
+    help='interpreter flags for the execv path'
+  )
+  parser.add_option(
+    '-n', '--runs', action='store', type='int', dest='runs', default=20,
+    help='number of warm runs per path'
+  )
+  return parser.parse_args()[0]
+
+if '__main__' == __name__:
+  options = _get_options()
+  repo = tempfile.mkdtemp(prefix='evolve-bench-')
+  args = ['-r', repo, 'echo', 'bench']
+  # -m puts the working directory on the path, which lets the execv path find
+  # the source tree even with -E
+  cwd = os.path.normpath(_PythonDir)
+
+  try:
+    print '%-24s %10s %10s %10s %10s' % (
+      'path', 'cold', 'min', 'median', 'max'
+    )
+    for name, argv in [
+      ('system("sh -c ...")', _old_path(options.python, args)),
+      ('execv(python)', _new_path(options.python, '', args)),
+      ('execv(python %s)' % options.flags,
+        _new_path(options.python, options.flags, args)),
+    ]:
+      dropped, cold, warm = _time(argv, options.runs, cwd)
+      print '%-24s %9.1fms %9.1fms %9.1fms %9.1fms%s' % (
+        name, 1000 * cold, 1000 * warm[0], 1000 * warm[len(warm) / 2],
+        1000 * warm[-1], '' if dropped else ' (cache not dropped)'
+      )
+  finally:
+    os.rmdir(repo)
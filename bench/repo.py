@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+  Times repository operations against a synthetic repository, built in a
+  temporary directory: a tree of projects --depth levels deep and --breadth
+  wide, --releases spread over its leaves, --installs of them installed from
+  bin/ trees of --files files and deployed, and --rlinks with --updates
+  history entries each. Then times walks, directory listings, history reads
+  and cold starts of the CLI against it.
+
+  The results are printed as JSON: for each operation, the count and the
+  total, mean, min, median, 95th percentile and max seconds, along with the
+  parameters and the revision measured, so runs can be compared between
+  versions. Neither root nor the evolve user is needed: the repository is
+  initialized directly rather than through init, and the CLI's logs go to
+  the temporary directory.
+'''
+
+__author__ = 'Will Leszczuk'
+
+import os, sys, time, json, shutil, tempfile, subprocess
+from collections import OrderedDict
+from optparse import OptionParser
+
+_PythonDir = os.path.normpath(
+  os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python')
+)
+sys.path.insert(0, _PythonDir)
+
+from evolve.shared.repo import Repository
+
+def _summarize(times):
+  times = sorted(times)
+  if not times: return OrderedDict([('count', 0)])
+  return OrderedDict([
+    ('count', len(times)),
+    ('total', sum(times)),
+    ('mean', sum(times) / len(times)),
+    ('min', times[0]),
+    ('median', times[len(times) / 2]),
+    ('p95', times[min(len(times) - 1, int(len(times) * 0.95))]),
+    ('max', times[-1]),
+  ])
+
+def _time(results, name, fn, items):
+  times = []
+  for item in items:
+    start = time.time()
+    fn(item)
+    times.append(time.time() - start)
+  results[name] = _summarize(times)
+  print >> sys.stderr, '%-28s %8d %9.3fs' % (
+    name, len(times), results[name].get('total', 0)
+  )
+
+def _get_projects(depth, breadth):
+  # parents before children, so each create makes a single project
+  levels = [['p%d' % i for i in range(breadth)]]
+  while len(levels) < depth:
+    levels.append([
+      '%s/p%d' % (parent, i) for parent in levels[-1] for i in range(breadth)
+    ])
+  return [p for level in levels for p in level], levels[-1]
+
+def _make_artifact(path, files):
+  # spread over directories of 64, like a typical build output
+  for i in range(files):
+    directory = os.path.join(path, 'd%d' % (i / 64))
+    if not os.path.exists(directory): os.makedirs(directory)
+    with open(os.path.join(directory, 'f%d' % i), 'w') as artifact:
+      artifact.write(('%d\n' % i) * (1 + i % 256))
+
+def _get_revision():
+  try:
+    with open(os.devnull, 'w') as devnull:
+      return subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], cwd=_PythonDir, stderr=devnull
+      ).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def _run(options, root):
+  results = OrderedDict()
+  path = os.path.join(root, 'repo')
+  os.mkdir(path)
+  Repository._init_repo(path)
+  repo = Repository(path)
+  if options.store: repo.init_store()
+
+  projects, leaves = _get_projects(options.depth, options.breadth)
+  _time(results, 'create_project', repo.create_project, projects)
+
+  releases = [
+    '%s/r%d' % (leaves[i % len(leaves)], i) for i in range(options.releases)
+  ]
+  _time(results, 'create_release', repo.create_release, releases)
+
+  installed = releases[:options.installs]
+  artifact = os.path.join(root, 'artifact')
+  _make_artifact(artifact, options.files)
+  for release in installed:
+    shutil.copytree(
+      artifact, os.path.join(path, release, 'src', 'build'), symlinks=True
+    )
+  install = lambda release: repo.install(
+    release, 'build', jobs=options.jobs
+  )
+  _time(results, 'install', install, installed)
+  _time(results, 'install_unchanged', install, installed)
+  _time(results, 'deploy', repo.deploy, installed)
+
+  # rlinks alternate between the first two releases of their project
+  rlinks = []
+  for leaf in leaves[:options.rlinks]:
+    targets = [r for r in releases if r.startswith(leaf + '/')][:2]
+    if 2 == len(targets): rlinks.append((leaf + '/live', targets))
+  _time(
+    results, 'create_rlink',
+    lambda (rlink, targets): repo.create_rlink(
+      targets[0], os.path.basename(rlink)
+    ),
+    rlinks
+  )
+  _time(
+    results, 'update_rlink',
+    lambda (rlink, target): repo.update_rlink(
+      target, os.path.basename(rlink)
+    ),
+    [
+      (rlink, targets[(i + 1) % 2])
+        for i in range(options.updates) for rlink, targets in rlinks
+    ]
+  )
+
+  runs = range(options.runs)
+  _time(results, 'walk', lambda i: repo.walk('', lambda *args: None), runs)
+  _time(
+    results, 'get_directory_contents', repo.get_directory_contents,
+    [''] + projects
+  )
+  rlinkpaths = [rlink for rlink, targets in rlinks]
+  _time(results, 'get_history', repo.get_history, rlinkpaths)
+  _time(
+    results, 'get_history_limit_10',
+    lambda rlink: repo.get_history(rlink, 10), rlinkpaths
+  )
+
+  env = dict(os.environ)
+  env.update({
+    'PYTHONPATH': _PythonDir, 'EVOLVE_REPO': path,
+    'EVOLVE_LOG_DIR': os.path.join(root, 'logs'),
+  })
+  with open(os.devnull, 'w') as devnull:
+    def _cli(argv):
+      if 0 != subprocess.call(
+        [options.python, '-m', 'evolve.cli.evolvecli'] + argv, env=env,
+        stdout=devnull
+      ):
+        raise Exception('evolve %s failed' % ' '.join(argv))
+    _time(results, 'cli_echo', _cli, [['echo', 'bench']] * options.runs)
+    _time(results, 'cli_ls', _cli, [['ls', leaves[0]]] * options.runs)
+  return results
+
+def _get_options():
+  parser = OptionParser(description=__doc__, usage='usage: %prog [OPTIONS]')
+  parser.add_option(
+    '--depth', action='store', type='int', dest='depth', default=3,
+    help='levels of projects'
+  )
+  parser.add_option(
+    '--breadth', action='store', type='int', dest='breadth', default=4,
+    help='subprojects of each project'
+  )
+  parser.add_option(
+    '-n', '--releases', action='store', type='int', dest='releases',
+    default=10000, help='releases, spread over the leaf projects'
+  )
+  parser.add_option(
+    '-i', '--installs', action='store', type='int', dest='installs',
+    default=20, help='releases to install and deploy'
+  )
+  parser.add_option(
+    '-f', '--files', action='store', type='int', dest='files', default=2000,
+    help='files in each installed bin/ tree'
+  )
+  parser.add_option(
+    '-l', '--rlinks', action='store', type='int', dest='rlinks', default=16,
+    help='leaf projects given an rlink'
+  )
+  parser.add_option(
+    '-u', '--updates', action='store', type='int', dest='updates',
+    default=200, help='updates (and so history entries) of each rlink'
+  )
+  parser.add_option(
+    '-j', '--jobs', action='store', type='int', dest='jobs', default=1,
+    help='files to install concurrently'
+  )
+  parser.add_option(
+    '-s', '--store', action='store_true', dest='store', default=False,
+    help='install through an object store'
+  )
+  parser.add_option(
+    '--runs', action='store', type='int', dest='runs', default=10,
+    help='runs of each walk and CLI measurement'
+  )
+  parser.add_option(
+    '-p', '--python', action='store', dest='python', default=sys.executable,
+    help='the interpreter to launch the CLI with'
+  )
+  parser.add_option(
+    '-o', '--output', action='store', dest='output', default=None,
+    help='write the results here rather than to stdout'
+  )
+  parser.add_option(
+    '-k', '--keep', action='store_true', dest='keep', default=False,
+    help='leave the temporary directory in place'
+  )
+  return parser.parse_args()[0]
+
+if '__main__' == __name__:
+  options = _get_options()
+  root = tempfile.mkdtemp(prefix='evolve-bench-')
+  try: results = _run(options, root)
+  finally:
+    if options.keep: print >> sys.stderr, 'left [%s]' % root
+    else: shutil.rmtree(root)
+
+  report = OrderedDict([
+    ('revision', _get_revision()),
+    ('python', sys.version.split()[0]),
+    ('time', time.time()),
+    ('parameters', OrderedDict(
+      (key, getattr(options, key)) for key in [
+        'depth', 'breadth', 'releases', 'installs', 'files', 'rlinks',
+        'updates', 'jobs', 'store', 'runs'
+      ]
+    )),
+    ('results', results),
+  ])
+  output = open(options.output, 'w') if options.output else sys.stdout
+  json.dump(report, output, indent=2)
+  output.write('\n')
+  if options.output: output.close()
@@ -27,52 +27,177 @@
 #include <stdlib.h>
 #include <string.h>
 #include <stdio.h>
+#include <limits.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <arpa/inet.h>
 
 #define MIN(x, y) (y) > (x) ? (x) : (y)
-#define BASE "python -m evolve.cli.evolvecli "
+#define MODULE "evolve.cli.evolvecli"
+#define SOCKET_PATH "/var/run/evolve/evolved.sock"
+#define PROTOCOL "evolve2"
+#define NO_DAEMON "EVOLVE_NO_DAEMON"
 
-int main(int argc, char **argv) {
-  char command[20 * 1024] = BASE;
-  int bufindex = sizeof(BASE)-1, i = 1, result = 1;
-
-  for (; i < argc; ++i) 
-  { 
-    char *singlequot;
-    command[bufindex++] = '"';
-    while (0 != (singlequot = strchr(argv[i], '"')))
+/*
+  The interpreter and its flags are fixed at build time (see the Makefile):
+  this binary runs setuid, so they must not come from the environment. -E
+  keeps PYTHON* variables from affecting the interpreter and -S skips the
+  site scan; evolve itself is installed into the standard library directory.
+*/
+#ifndef EVOLVE_PYTHON
+#define EVOLVE_PYTHON "/usr/bin/python"
+#endif
+#ifndef EVOLVE_PYFLAGS
+#define EVOLVE_PYFLAGS "-ES"
+#endif
+
+/*
+  The variables passed on to evolved, which gives the command only these
+  (it keeps the same list, as _ForwardedEnv). Anything naming a path to
+  write to must stay off it: the daemon writes as the evolve user.
+*/
+static const char *FORWARDED_ENV[] = {
+  "EVOLVE_REPO", "EVOLVE_PROFILE", "EVOLVE_HISTORY_RETENTION", 0
+};
+
+static int write_bytes(int fd, const char *data, size_t len)
+{
+  size_t done = 0;
+  ssize_t n;
+  while (done < len)
+  {
+    if (0 > (n = write(fd, data + done, len - done))) { return -1; }
+    done += n;
+  }
+  return 0;
+}
+
+static int write_field(int fd, const char *field)
+{
+  return write_bytes(fd, field, strlen(field) + 1);
+}
+
+static int write_env(int fd)
+{
+  char count[32];
+  const char *value;
+  int i, n = 0;
+
+  for (i = 0; FORWARDED_ENV[i]; ++i) { n += 0 != getenv(FORWARDED_ENV[i]); }
+  snprintf(count, sizeof(count), "%d", n);
+  if (0 != write_field(fd, count)) { return -1; }
+
+  for (i = 0; FORWARDED_ENV[i]; ++i)
+  {
+    if (0 == (value = getenv(FORWARDED_ENV[i]))) { continue; }
+    if (0 != write_bytes(fd, FORWARDED_ENV[i], strlen(FORWARDED_ENV[i]))
+     || 0 != write_bytes(fd, "=", 1) || 0 != write_field(fd, value))
     {
-      /* TODO: inefficient, but works --------------------------------------- */
-      strncpy(
-        command + bufindex, 
-        argv[i], 
-        MIN(singlequot - argv[i] - 1, sizeof(command) - bufindex - 1)
-      );
-      bufindex += strlen(command + bufindex);
-      /* -------------------------------------------------------------------- */
-      if (bufindex >= sizeof(command) - 2) { break; }
-      command[bufindex++] = '\\';
-      command[bufindex++] = '"';
-      argv[i] = 1 + singlequot;
+      return -1;
     }
-    /* TODO: inefficient, but works ----------------------------------------- */
-    strncpy(
-      command + bufindex,
-      argv[i],
-      sizeof(command) - bufindex - 1
-    );
-    bufindex += strlen(command + bufindex);
-    /* ---------------------------------------------------------------------- */
-    if (bufindex >= sizeof(command) - 2) { break; }
-    command[bufindex++] = '"';
-    command[bufindex++] = ' ';
   }
+  return 0;
+}
+
+static int read_all(int fd, char *buf, size_t len)
+{
+  size_t done = 0;
+  ssize_t n;
+  while (done < len)
+  {
+    if (0 >= (n = read(fd, buf + done, len - done))) { return -1; }
+    done += n;
+  }
+  return 0;
+}
+
+/*
+  Forwards the invocation to evolved (see evolve/cli/evolved.py for the
+  protocol). Returns the exit code of the command, or -1 if the daemon isn't
+  running or asked for the command to be run in-process.
+*/
+static int forward(int argc, char **argv)
+{
+  struct sockaddr_un addr;
+  char cwd[PATH_MAX], uid[32], header[5], buf[8192];
+  int fd, i, result = -1;
+  uint32_t value;
+
+  if (0 != getenv(NO_DAEMON)) { return -1; }
+  if (0 > (fd = socket(AF_UNIX, SOCK_STREAM, 0))) { return -1; }
+
+  memset(&addr, 0, sizeof(addr));
+  addr.sun_family = AF_UNIX;
+  strncpy(addr.sun_path, SOCKET_PATH, sizeof(addr.sun_path) - 1);
+  if (0 != connect(fd, (struct sockaddr *)&addr, sizeof(addr)))
+  {
+    close(fd);
+    return -1;
+  }
+
+  if (0 == getcwd(cwd, sizeof(cwd))) { strcpy(cwd, "/"); }
+  snprintf(uid, sizeof(uid), "%d", (int)getuid());
 
-  if (bufindex >= sizeof(command)) { printf("command exceeds 20k limit\n"); }
-  else
+  if (0 != write_field(fd, PROTOCOL) || 0 != write_field(fd, uid)
+   || 0 != write_field(fd, cwd) || 0 != write_env(fd))
+  {
+    close(fd);
+    return -1;
+  }
+  for (i = 1; i < argc; ++i)
   {
-    command[bufindex] = '\0';
-    result = system(command);
+    if (0 != write_field(fd, argv[i])) { close(fd); return -1; }
   }
+  shutdown(fd, SHUT_WR);
 
+  for (;;)
+  {
+    if (0 != read_all(fd, header, sizeof(header)))
+    {
+      /* the command may have partially run, so don't retry in-process */
+      fprintf(stderr, "lost connection to evolved\n");
+      result = 1;
+      break;
+    }
+    memcpy(&value, header + 1, sizeof(value));
+    value = ntohl(value);
+
+    if ('X' == header[0]) { result = (int)value; break; }
+    if ('F' == header[0]) { result = -1; break; }
+
+    while (0 < value)
+    {
+      size_t chunk = MIN(value, sizeof(buf));
+      if (0 != read_all(fd, buf, chunk)) { value = 0; break; }
+      fwrite(buf, 1, chunk, 'E' == header[0] ? stderr : stdout);
+      value -= chunk;
+    }
+  }
+
+  fflush(stdout);
+  close(fd);
   return result;
 }
+
+int main(int argc, char **argv) {
+  char **args;
+  int i = 0, result;
+
+  if (0 <= (result = forward(argc, argv))) { return result; }
+
+  if (0 == (args = malloc((argc + 4) * sizeof(char *))))
+  {
+    perror("evolve");
+    return 1;
+  }
+  args[i++] = EVOLVE_PYTHON;
+  if ('\0' != EVOLVE_PYFLAGS[0]) { args[i++] = EVOLVE_PYFLAGS; }
+  args[i++] = "-m";
+  args[i++] = MODULE;
+  /* the arguments go through untouched, along with the terminating NULL */
+  memcpy(args + i, argv + 1, argc * sizeof(char *));
+
+  execv(EVOLVE_PYTHON, args);
+  perror(EVOLVE_PYTHON);
+  return 1;
+}
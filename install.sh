@@ -30,6 +30,7 @@ cp bootstrap/build/evolve /usr/bin/
 
 lib=`python -c 'import sys;print sys.path' | tr ',' '\n' | egrep "^[[:space:]]*['\"]/usr/lib/python[[:digit:]\\.]*['\"]\\s*$" | tr '"' "'" | cut -d "'" -f 2`
 cp -rf ./python/evolve/ "$lib"
+(cd / && python -m evolve.cli.manifest)
 
 echo 'initializing platform...'
 ./initplatform.py
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+
+'''
+
+__author__ = 'Will Leszczuk'
+import sys, shlex, time
+from evolve.shared.repo import get_repository, RepoError
+from evolve.cli.evolvecli import run_command, log_command, \
+  parse_command_line, UsageError, CommandError
+
+class Command(object):
+  '''
+    Applies the create, install, deploy, update, rollback and deps
+    commands listed in a file (one per line, - for stdin) as a single
+    transaction: if any of them fails, none of them take effect.
+    Each line may carry options of its own, such as install -c.
+    usage: evolve batch <file>
+  '''
+
+  Commands = ['create', 'install', 'deploy', 'update', 'rollback', 'deps']
+
+  def __call__(self, options, filename):
+    if '-' == filename: lines = sys.stdin.readlines()
+    else:
+      try:
+        with open(filename, 'r') as batchfile: lines = batchfile.readlines()
+      except IOError, ex:
+        raise CommandError('unable to read batch file: %s' % ex.strerror)
+
+    commands = []
+    for lineno, line in enumerate(lines):
+      try:
+        lineoptions, args = \
+          parse_command_line(shlex.split(line, comments=True), options)
+      except (ValueError, UsageError), ex:
+        raise CommandError('line %d: %s' % (lineno + 1, ex))
+      if 0 == len(args): continue
+      if not args[0] in Command.Commands:
+        raise CommandError(
+          'line %d: [%s] cannot be batched' % (lineno + 1, args[0])
+        )
+      if lineoptions.repo != options.repo:
+        raise CommandError(
+          'line %d: commands cannot be batched across repositories'
+            % (lineno + 1)
+        )
+      commands.append((lineno + 1, lineoptions, args))
+
+    # logged once the transaction is over, as whatever became of them
+    done = []
+    try:
+      with get_repository(options.repo).transaction():
+        for lineno, lineoptions, args in commands:
+          start = time.time()
+          try: result = run_command(args[0], lineoptions, *args[1:])
+          except (UsageError, CommandError, RepoError), ex:
+            log_command(
+              args[0], args[1:], str(ex), lineoptions, time.time() - start,
+              'failed'
+            )
+            raise CommandError('line %d: %s (nothing applied)' % (lineno, ex))
+          done.append((args, lineoptions, result, time.time() - start))
+    except BaseException:
+      for args, lineoptions, result, seconds in done:
+        log_command(
+          args[0], args[1:], result, lineoptions, seconds, 'rolled back'
+        )
+      raise
+
+    for args, lineoptions, result, seconds in done:
+      log_command(args[0], args[1:], result, lineoptions, seconds)
+    return 'applied %d commands' % len(commands)
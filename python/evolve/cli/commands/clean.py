@@ -29,16 +29,31 @@
 
 __author__ = 'Will Leszczuk'
 
-from evolve.shared.repo import Repository
-from evolve.shared.util import columnize_best_fit
+import time
+from evolve.shared.repo import get_repository
+from evolve.cli.commands import CommandError
 
 class Command(object):
   '''
-    Attempts to remove abandoned lock files in the event of a system
-    error. If an active process still holds the lock, this operation
-    will fail.
-    usage: evolve clean <path>
+    Removes lock files, lock queue tickets and partially written
+    metadata abandoned by crashed processes. Locks held by processes
+    that have died are taken over. With -R, cleans every location
+    beneath the path too, reporting those still in use.
+    usage: evolve clean [-R] <path>
   '''
   
   def __call__(self, options, path):
-    Repository(options.repo).clean(path)
+    cleaned, busy = get_repository(options.repo).clean(path, options.recursive)
+    inuse = [
+      '[%s] is in use by %s' % (path, self.describe(owner))
+        for path, owner in busy
+    ]
+    if not options.recursive:
+      if inuse: raise CommandError(inuse[0])
+      return
+    return '\n'.join(['cleaned %d locations' % cleaned] + inuse)
+
+  def describe(self, owner):
+    if None is owner: return 'a reader'
+    pid, host, starttime, locktime = owner
+    return 'pid %d on %s since %s' % (pid, host, time.ctime(locktime))
@@ -29,8 +29,8 @@
 
 __author__ = 'Will Leszczuk'
 
-import os
-from evolve.shared.util import columnize, get_modules, coalesce
+from evolve.shared.util import columnize
+from evolve.cli.manifest import get_manifest
 
 class Command(object):
   '''
@@ -38,25 +38,11 @@ class Command(object):
     usage: evolve commands
   '''
 
-  _modprefix = 'evolve.cli.commands.'
-
-  def _get_files():
-    return [
-      c for c in os.listdir(os.path.dirname(__file__)) 
-        if c.endswith('.py') and -1 == c.find('__init__')
-    ]
-  _get_files = staticmethod(_get_files)
-
   def __call__(self, options):
-    files = Command._get_files()
-    files.sort()
-    modules = get_modules(Command._modprefix, files)
-    commandWidth = 2 + max(*[len(n) for (n, m) in modules])
-    striplen = len(Command._modprefix)
+    manifest = get_manifest()
+    commandWidth = 2 + max(*[len(n) for n in manifest])
     columnize(
       '  ',
       (commandWidth, 77 - commandWidth), 
-      [(s.__name__[striplen:], coalesce(s.Command.__doc__, '').strip()) 
-        for s in [getattr(m.cli.commands, n) for (n, m) in modules]
-      ]
+      [(name, manifest[name]['doc'].strip()) for name in sorted(manifest)]
     )
@@ -29,7 +29,7 @@
 
 __author__ = 'Will Leszczuk'
 
-from evolve.shared.repo import Repository, ArgumentError
+from evolve.shared.repo import get_repository, ArgumentError
 from evolve.cli.commands import CommandError
 
 class Command(object):
@@ -50,5 +50,5 @@ class Command(object):
     if 'rlink' != type and not None is name:
       raise CommandError('too many arguments to create')
 
-    repo = Repository(options.repo)
+    repo = get_repository(options.repo)
     getattr(repo, 'create_' + type)(*args)
@@ -29,15 +29,39 @@
 
 __author__ = 'Will Leszczuk'
 
-from evolve.shared.repo import Repository
+import time
+from evolve.shared.repo import get_repository
 from evolve.shared.util import columnize_best_fit
+from evolve.cli.commands import CommandError
 
 class Command(object):
   '''
     Marks a release as 'deployed', qualifying it for push to another repository.
-    usage: evolve deploy <path>
+    -R deploys every release it depends on first, in waves of
+    releases that don't depend on each other, -j at a time.
+    usage: evolve deploy [-R] [-j N] <path>
   '''
   
   def __call__(self, options, release):
     # TODO: confirmation
-    Repository(options.repo).deploy(release)
+    repo = get_repository(options.repo)
+    if not options.recursive:
+      repo.deploy(release)
+      return
+
+    start = time.time()
+    results, skipped = repo.deploy_all(release, options.jobs)
+    for path, wave, seconds, error in results:
+      print '  %d  %-50s %s' % (
+        wave, path, '%.2fs' % seconds if None is error else 'failed: %s' % error
+      )
+    failed = [r for r in results if not None is r[3]]
+    summary = 'deployed %d of %d releases in %d waves in %.2fs' % (
+      len(results) - len(failed), len(results) + len(skipped),
+      max([r[1] for r in results]), time.time() - start
+    )
+    if failed:
+      raise CommandError(
+        '%s (%d failed, %d skipped)' % (summary, len(failed), len(skipped))
+      )
+    return summary
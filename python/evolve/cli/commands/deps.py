@@ -0,0 +1,54 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+
+'''
+
+__author__ = 'Will Leszczuk'
+
+from evolve.shared.repo import get_repository
+from evolve.cli.commands import CommandError
+
+class Command(object):
+  '''
+    Manages the dependencies between releases and rlinks. list shows
+    what a node depends on, rdeps what depends on it, both
+    transitively with -R. An rlink always depends on its target.
+    usage: evolve deps [-R] [list|rdeps|add|remove] <path> [<dep> ...]
+  '''
+
+  def __call__(self, options, action, path, *dependencies):
+    repo = get_repository(options.repo)
+    if 'list' == action:
+      return '\n'.join(repo.get_dependencies(path, options.recursive))
+    elif 'rdeps' == action:
+      return '\n'.join(repo.get_dependents(path, options.recursive))
+    elif 'add' == action:
+      repo.add_dependencies(path, *dependencies)
+    elif 'remove' == action:
+      repo.remove_dependencies(path, *dependencies)
+    else:
+      raise CommandError('bad action passed to deps')
@@ -29,7 +29,8 @@
 
 __author__ = 'Will Leszczuk'
 
-from evolve.cli.evolvecli import get_command
+from evolve.cli.manifest import get_manifest
+from evolve.cli.commands import CommandError
 
 class Command(object):
   '''
@@ -38,4 +39,7 @@ class Command(object):
   '''
 
   def __call__(self, options, commandname):
-    return get_command(commandname).__doc__
+    manifest = get_manifest()
+    if not commandname in manifest:
+      raise CommandError('invalid command [%s]' % commandname)
+    return manifest[commandname]['doc']
@@ -29,25 +29,38 @@
 
 __author__ = 'Will Leszczuk'
 
-from time import ctime
-from evolve.shared.repo import Repository
+import time
+from evolve.shared.repo import get_repository
 from evolve.shared.util import columnize_best_fit
+from evolve.cli.commands import CommandError
 
 class Command(object):
   '''
-    Displays the history of an rlink.
-    usage: evolve history <path>
+    Displays the history of an rlink, newest first: --limit entries
+    at most, from --since on. --keep compacts it to that many
+    entries instead (every rlink beneath the path with -R).
+    usage: evolve history [--limit N] [--since <date>] <path>
+           evolve history [-R] --keep N <path>
   '''
+
+  DateFormats = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']
   
   def __call__(self, options, path=''):
-    history = Repository(options.repo).get_history(path)
+    repo = get_repository(options.repo)
+    if not None is options.keep:
+      return 'dropped %d entries' % repo.compact_history(
+        path, options.keep, options.recursive
+      )
+
+    since = None if None is options.since else self.parse_date(options.since)
+    history = repo.get_history(path, options.limit, since)
     print
     print '  +' + '-' * 76 + '+'
     columnize_best_fit(
       '  | ',
       80,
         [('Target', 'Modified By', 'Last Modified')]
-      + [(h[0], h[1], ctime(h[2])) for h in history],
+      + [(h[0], h[1], time.ctime(h[2])) for h in history],
       newline=False,
       sep = ' | ',
       suffix = ' |',
@@ -55,3 +68,9 @@ class Command(object):
     )
     print '  +' + '-' * 76 + '+'
     print
+
+  def parse_date(self, value):
+    for format in Command.DateFormats:
+      try: return time.mktime(time.strptime(value, format))
+      except ValueError: pass
+    raise CommandError('unrecognized date: [%s]' % value)
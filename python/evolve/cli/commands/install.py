@@ -29,14 +29,22 @@
 
 __author__ = 'Will Leszczuk'
 
-from evolve.shared.repo import Repository
-from evolve.shared.util import columnize_best_fit
+from evolve.shared.repo import get_repository
+from evolve.shared.util import columnize_best_fit, ProgressLine
 
 class Command(object):
   '''
-    Installs build artifacts into the target release's bin/ folder.
-    usage: evolve install <path> <artifact_rel_path>
+    Installs build artifacts into the target release's bin/ folder,
+    copying only changed files (-c compares contents; --rsync uses
+    rsync instead) with -j threads. -p reports progress.
+    usage: evolve install [-c] [--rsync] [-j N] [-p] <path> <artifact_rel_path>
   '''
-  
+
   def __call__(self, options, release, artifactpath):
-    Repository(options.repo).install(release, artifactpath)
+    progress = ProgressLine() if options.progress else None
+    stats = get_repository(options.repo).install(
+      release, artifactpath, options.checksum, options.rsync, options.jobs,
+      None if None is progress else progress.sync_stats
+    )
+    if not None is progress: progress.end()
+    if not None is stats: return str(stats)
@@ -29,13 +29,15 @@
 
 __author__ = 'Will Leszczuk'
 
-from evolve.shared.repo import Repository
+from evolve.shared.repo import get_repository
 from evolve.shared.util import columnize_best_fit, interleave_tuples
 
 class Command(object):
   '''
-    Lists the contents of the specified meta folder.
-    usage: evolve ls [-R] <path>='/'
+    Lists the contents of the specified meta folder. -R lists the
+    tree beneath it, down to --depth levels. With --type, --name,
+    --deployed or --undeployed, -R lists the matching paths instead.
+    usage: evolve ls [-R] [--depth N] [<filters>] <path>='/'
   '''
   
   TypeMap = {
@@ -46,8 +48,17 @@ class Command(object):
   }
 
   def __call__(self, options, path=''):
-    repo = Repository(options.repo)
-    getattr(self, 'ls' if not options.recursive else 'graph')(repo, path)
+    repo = get_repository(options.repo)
+    if not options.recursive:
+      self.ls(repo, path)
+    elif None is options.types and None is options.name \
+      and None is options.deployed:
+      self.graph(repo, path, options.depth)
+    else:
+      self.find(
+        repo, path, options.depth, options.types, options.deployed,
+        options.name
+      )
 
   def ls(self, repo, path):
     (target, children) = repo.get_directory_contents(path)
@@ -85,14 +96,22 @@ class Command(object):
 
     print
 
-  def graph(self, repo, path):
+  def graph(self, repo, path, depth):
     print
-    def _graph(path, more, type):
-      path = '/' if '' == path else path.split('/')[-1]
+    more = []
+    for path, depth, last, metafile in repo.iterwalk(path, depth):
+      del more[depth:]
       print '  %s+ [%s] %s' % (
-        ''.join(['|  ' if m else ' ' * 3 for m in more[:-1]]),
-        Command.TypeMap[type],
-        path
+        ''.join(['|  ' if m else ' ' * 3 for m in more]),
+        Command.TypeMap[metafile.get_type()],
+        '/' if '' == path else path.split('/')[-1]
       )
-    repo.walk(path, _graph)
+      more.append(not last)
     print
+
+  def find(self, repo, path, depth, types, deployed, name):
+    for path, depth, last, metafile in \
+      repo.iterwalk(path, depth, types, deployed, name):
+      print '  [%s] %s' % (
+        Command.TypeMap[metafile.get_type()], '/' + path
+      )
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+
+'''
+
+__author__ = 'Will Leszczuk'
+
+from evolve.shared.repo import get_repository
+from evolve.shared.stream import RemoteError
+from evolve.shared.util import format_bytes, ProgressLine
+from evolve.cli.commands import CommandError
+
+class Command(object):
+  '''
+    Copies a deployed release, or an rlink and its target, to another
+    repository along with everything it depends on. Only files
+    missing from the target's object store are copied (-c compares
+    contents of files already in place) by -j threads. --pipe pushes
+    to an `evolve receive' run by a shell command instead, resuming
+    if the stream breaks.
+    usage: evolve push [-c] [-j N] [-p] <path> <target_repo>
+           evolve push [-p] --pipe <command> <path>
+  '''
+
+  def __call__(self, options, path, target=None):
+    progress = ProgressLine() if options.progress else None
+    repo = get_repository(options.repo)
+    if not None is options.pipe:
+      try:
+        results, sent = repo.push_stream(
+          path, options.pipe,
+          None if None is progress else lambda done, total: progress.write(
+            'sent %s of %s' % (format_bytes(done), format_bytes(total))
+          )
+        )
+      except RemoteError, ex:
+        raise CommandError('target repository: %s' % ex)
+      finally:
+        if not None is progress: progress.end()
+      self.report(results)
+      return 'pushed %d of %d releases and rlinks (%s sent)' % (
+        len([r for r in results if 'present' != r[1]]), len(results),
+        format_bytes(sent)
+      )
+
+    if None is target: raise CommandError('no target repository given')
+    results = repo.push(
+      path, target, options.checksum, options.jobs,
+      None if None is progress else progress.sync_stats
+    )
+    if not None is progress: progress.end()
+
+    self.report(results)
+    copied = sum([s.bytes for n, a, s in results if not None is s])
+    return 'pushed %d of %d releases and rlinks (%s copied)' % (
+      len([r for r in results if 'present' != r[1]]), len(results),
+      format_bytes(copied)
+    )
+
+  def report(self, results):
+    for node, action, stats in results:
+      if None is stats: print '  %-10s %s' % (action, node)
+      else: print '  %-10s %s: %s' % (action, node, stats)
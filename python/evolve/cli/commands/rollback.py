@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+
+'''
+
+__author__ = 'Will Leszczuk'
+
+import time
+from evolve.shared.repo import get_repository
+from evolve.cli.commands import CommandError
+
+class Command(object):
+  '''
+    Points an rlink back at a previous target from its history: the
+    release before the current one, the one --steps releases back, or
+    the release named by --to. Releases a rollback moved away from are
+    skipped, so rolling back again goes further back rather than
+    undoing the last rollback. -R rolls back every rlink beneath the
+    path, -j at a time.
+    usage: evolve rollback [-R] [-j N] [-t] [--steps N | --to <release>] <path>
+  '''
+
+  def __call__(self, options, path):
+    if not None is options.steps and not None is options.to:
+      raise CommandError('only one of --steps and --to can be given')
+    steps = 1 if None is options.steps else options.steps
+
+    repo = get_repository(options.repo)
+    if not options.recursive:
+      before, after = repo.rollback_rlink(
+        path, steps, options.to, options.touch
+      )
+      return '%s: %s -> %s' % (path.strip().strip('/'), before, after)
+
+    start = time.time()
+    results = repo.rollback_all(
+      path, steps, options.to, options.touch, options.jobs
+    )
+    for rlink, before, after, seconds, error in results:
+      print '  %-40s %s' % (
+        rlink, '%s -> %s  %.2fs' % (before, after, seconds)
+          if None is error else 'failed: %s' % error
+      )
+    failed = [r for r in results if not None is r[4]]
+    summary = 'rolled back %d of %d rlinks in %.2fs' % (
+      len(results) - len(failed), len(results), time.time() - start
+    )
+    if failed: raise CommandError('%s (%d failed)' % (summary, len(failed)))
+    return summary
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+
+'''
+
+__author__ = 'Will Leszczuk'
+
+from evolve.shared.repo import get_repository
+from evolve.shared.util import format_bytes
+from evolve.cli.commands import CommandError
+
+class Command(object):
+  '''
+    Manages the repository's content-addressed artifact store, which
+    shares identical artifacts between releases via hardlinks.
+    usage: evolve store [init|stats|prune]
+  '''
+
+  def __call__(self, options, action='stats'):
+    repo = get_repository(options.repo)
+    if 'init' == action:
+      repo.init_store()
+    elif 'stats' == action:
+      blobs, size, unused, unusedsize = repo.get_store_stats()
+      return '%d blobs (%s), %d unused (%s)' % (
+        blobs, format_bytes(size), unused, format_bytes(unusedsize)
+      )
+    elif 'prune' == action:
+      return 'removed %d blobs' % repo.prune_store()
+    else:
+      raise CommandError('bad action passed to store')
@@ -29,18 +29,19 @@
 
 __author__ = 'Will Leszczuk'
 
-from evolve.shared.repo import Repository, ArgumentError
+from evolve.shared.repo import get_repository, ArgumentError
 from evolve.cli.commands import CommandError
 
 class Command(object):
   '''
-    Updates a meta folder in the evolve repository.
-    usage: evolve update rlink <release_path> <name>
+    Updates a meta folder in the evolve repository. With -t, files
+    that differ from the rlink's previous target are touched.
+    usage: evolve update [-t] rlink <release_path> <name>
   '''
 
   def __call__(self, options, type, path, name):
     if not type in ['rlink']:
       raise CommandError('bad meta type passed to update')
 
-    repo = Repository(options.repo)
-    repo.update_rlink(path, name)
+    repo = get_repository(options.repo)
+    repo.update_rlink(path, name, options.touch)
@@ -32,39 +32,71 @@ __author__ = 'Will Leszczuk'
 
 # TODO: log command before execute, dont print return val (never any)
 
-import sys, logging, os, time, pwd
+import sys, logging, os, time, pwd, copy
 from optparse import OptionParser
+from collections import OrderedDict
 from evolve.shared.util import get_logger
-from evolve.shared.repo import RepoError, ArgumentError
+from evolve.shared import instrument
+from evolve.shared.errors import RepoError, ArgumentError
+from evolve.shared.settings import set_lock_wait, set_history_retention
 from evolve.cli.commands import CommandError
+from evolve.cli.manifest import get_manifest
 
 class UsageError(Exception): pass
 
 EvolveUser = 'evolve'
 _modmap = { }
-_LogPath = '/var/log/evolve/'
+# name files for the invocation to write (--trace and --cprofile)
+_OutputEnv = ['EVOLVE_TRACE', 'EVOLVE_CPROFILE']
+
+def _get_log_path(env):
+  # a setuid evolve mustn't be pointed somewhere else to write as its user
+  if os.getuid() == os.geteuid() and env.get('EVOLVE_LOG_DIR'):
+    return os.path.join(env['EVOLVE_LOG_DIR'], '')
+  return '/var/log/evolve/'
+
+_LogPath = _get_log_path(os.environ)
 _CommandLog = _LogPath + 'commands.log'
 _SessionLog = _LogPath + 'sessions.log'
 
 def get_command(name):
+  if not name in get_manifest():
+    raise UsageError('invalid command [%s]' % name)
   if not name in _modmap: 
-    try: _modmap[name] = __import__('evolve.cli.commands.' + name)
+    try:
+      with instrument.span('import', command=name):
+        _modmap[name] = __import__('evolve.cli.commands.' + name)
     except ImportError, ex: 
       raise UsageError('invalid command [%s]: [%s]' % (name, str(ex)))
   return getattr(_modmap[name].cli.commands, name).Command()
 
 def execute_command(name, options, *args):
   '''
-    Executes an evolve command by name with the supplied options and arguments.
-    Returns the result code of the command, or 1 in case of an invocation error.
+    Executes an evolve command by name with the supplied options and arguments,
+    and writes it to the command log. Returns the command's output.
   '''
-  command = get_command(name)
-  logger = get_logger(
-    _CommandLog,
-    logging.DEBUG if options.debug else logging.INFO
-  )
+  start = time.time()
+  try: result = run_command(name, options, *args)
+  except RepoError, ex:
+    log_command(name, args, str(ex), options, time.time() - start, 'failed')
+    raise
+
+  log_command(name, args, result, options, time.time() - start)
+  if options.debug and 'evolve.shared.repo' in sys.modules:
+    from evolve.shared.repo import get_cache_stats
+    get_logger(_CommandLog, logging.INFO).debug(
+      'metafile cache: %d hits, %d misses, %d entries' % get_cache_stats()
+    )
+  return result
 
-  try: result = command(options, *args)
+def run_command(name, options, *args):
+  '''
+    Executes an evolve command as execute_command does, without logging it.
+  '''
+  command = get_command(name)
+  try:
+    with instrument.span('execute_command', command=name):
+      return command(options, *args)
   except TypeError, ex:
     # TODO: kind of crappy but it works
     if -1 != str(ex).find('__call__() takes '):
@@ -72,32 +104,67 @@ def execute_command(name, options, *args):
     raise
   except ArgumentError, ex:
     raise UsageError(ex)
-  except RepoError, ex:
-    _log_command(logger.error, name, args, str(ex), options)
-    raise
 
-  _log_command(logger.info, name, args, result, options)
-  return result
+_LogLevels = {
+  'ok': logging.INFO, 'failed': logging.ERROR, 'rolled back': logging.WARNING
+}
 
-def _log_command(meth, name, args, result, options):
-  meth(
-      '%s(%s) => %s (options = %s)'
-    % (
-      name,
-      ', '.join(args),
-      result,
-      str(
-        dict([
-          (key, val) for (key, val) in eval(str(options)).iteritems()
-          if not None is val and '' != val and False != val
-        ])
-      )
-    )
+def log_command(name, args, result, options, seconds, status='ok'):
+  '''
+    Writes a command to the command log, with a status of `ok', `failed' or
+    `rolled back' (for commands undone with the transaction they ran in).
+  '''
+  get_logger(
+    _CommandLog,
+    logging.DEBUG if options.debug else logging.INFO
+  ).log(
+    _LogLevels[status],
+    '%s(%s) => %s' % (name, ', '.join(args), result),
+    extra={ 'fields': OrderedDict([
+      ('command', name),
+      ('args', list(args)),
+      ('options', dict([
+        (key, val) for (key, val) in vars(options).iteritems()
+        if not None is val and '' != val and False != val
+      ])),
+      ('seconds', round(seconds, 6)),
+      ('status', status),
+    ]) }
   )
 
-def _get_options():
-  parser = OptionParser(
-    description=__doc__, usage='Usage: evolve [OPTIONS] <command> [<arg> ...]'
+class _CommandLineParser(OptionParser):
+  # for command lines read by another command, which can't just exit
+  def error(self, msg):
+    raise UsageError(msg)
+
+def parse_command_line(argv, options):
+  '''
+    Parses a command line read by another command (batch) over a copy of
+    that command's options. Returns the options and the arguments left;
+    invalid options raise UsageError.
+  '''
+  return _get_parser({ }, _CommandLineParser).parse_args(
+    argv, copy.deepcopy(options)
+  )
+
+def get_command_name(argv):
+  '''
+    Returns the name of the command an evolve command line runs, or None if
+    it doesn't parse (or asks for help, which this doesn't print).
+  '''
+  parser = _get_parser({ }, _CommandLineParser)
+  parser.remove_option('--help')
+  try: options, args = parser.parse_args(argv)
+  except UsageError: return None
+  return args[0] if args else None
+
+def _get_options(argv, env):
+  return _get_parser(env).parse_args(argv)
+
+def _get_parser(env, parserclass=OptionParser):
+  parser = parserclass(
+    prog='evolve', description=__doc__,
+    usage='Usage: evolve [OPTIONS] <command> [<arg> ...]'
   )
   parser.add_option(
     '-d', '--debug', action='store_true', dest='debug', 
@@ -105,7 +172,7 @@ def _get_options():
   )
   parser.add_option(
     '-r', '--repo', action='store', dest='repo', 
-    default=os.getenv('EVOLVE_REPO'),
+    default=env.get('EVOLVE_REPO'),
     help='the evolve repository upon which to operate'
   )
   parser.add_option(
@@ -116,47 +183,164 @@ def _get_options():
     '-f', '--force', action='store_true', dest='force',
     default=False, help='force action, suppress confirmations'
   )
-  return parser.parse_args()
+  parser.add_option(
+    '-c', '--checksum', action='store_true', dest='checksum',
+    default=False, help='compare file contents rather than size and mtime'
+  )
+  parser.add_option(
+    '--rsync', action='store_true', dest='rsync',
+    default=False, help='install build artifacts with rsync'
+  )
+  parser.add_option(
+    '-j', '--jobs', action='store', type='int', dest='jobs',
+    default=1, help='number of files or releases to process concurrently'
+  )
+  parser.add_option(
+    '-p', '--progress', action='store_true', dest='progress',
+    default=False, help='report progress of long-running operations'
+  )
+  parser.add_option(
+    '-t', '--touch', action='store_true', dest='touch',
+    default=False, help='touch changed files when retargeting an rlink'
+  )
+  parser.add_option(
+    '--steps', action='store', type='int', dest='steps',
+    default=None, help='how many rlink updates to roll back'
+  )
+  parser.add_option(
+    '--to', action='store', dest='to',
+    default=None, help='the previous target to roll an rlink back to'
+  )
+  parser.add_option(
+    '--depth', action='store', type='int', dest='depth',
+    default=None, help='how many levels to descend recursively'
+  )
+  parser.add_option(
+    '--type', action='append', dest='types', default=None,
+    choices=['project', 'release', 'rlink'],
+    help='only include locations of this type (repeatable)'
+  )
+  parser.add_option(
+    '--name', action='store', dest='name',
+    default=None, help='only include locations whose names match a glob'
+  )
+  parser.add_option(
+    '--deployed', action='store_true', dest='deployed',
+    default=None, help='only include deployed releases'
+  )
+  parser.add_option(
+    '--undeployed', action='store_false', dest='deployed',
+    help='only include releases that are not deployed'
+  )
+  parser.add_option(
+    '-w', '--wait', action='store', type='float', dest='wait',
+    default=0, help='seconds to wait for a locked repository location'
+  )
+  parser.add_option(
+    '--fifo', action='store_true', dest='fifo',
+    default=False, help='wait for locks in order of arrival'
+  )
+  parser.add_option(
+    '--limit', action='store', type='int', dest='limit',
+    default=None, help='show at most this many history entries'
+  )
+  parser.add_option(
+    '--since', action='store', dest='since',
+    default=None, help='show history from this date (YYYY-MM-DD[ HH:MM])'
+  )
+  parser.add_option(
+    '--keep', action='store', type='int', dest='keep',
+    default=None, help='compact rlink history to this many entries'
+  )
+  parser.add_option(
+    '--retention', action='store', dest='retention',
+    default=env.get('EVOLVE_HISTORY_RETENTION') or None,
+    help='history entries kept when rlink histories are compacted'
+  )
+  parser.add_option(
+    '--profile', action='store_true', dest='profile',
+    default=bool(env.get('EVOLVE_PROFILE')),
+    help='print where the time went to stderr'
+  )
+  parser.add_option(
+    '--trace', action='store', dest='trace',
+    default=env.get('EVOLVE_TRACE'),
+    help='write timed spans to this file (Chrome trace format)'
+  )
+  parser.add_option(
+    '--cprofile', action='store', dest='cprofile',
+    default=env.get('EVOLVE_CPROFILE'),
+    help='write cProfile stats for the command to this file'
+  )
+  parser.add_option(
+    '--pipe', action='store', dest='pipe',
+    default=None, help='push through a shell command running `receive\''
+  )
+  return parser
+
+def _writes_as_caller(forwarded):
+  # not if setuid, nor under evolved, which runs as the evolve user
+  return not forwarded and os.getuid() == os.geteuid()
 
-def _validate_args(options, args):
+def _validate_args(options, args, forwarded):
   if 1 > len(args):
     raise UsageError('a command is required (use `commands\' for a list)')
   elif None is options.repo:
     raise UsageError('an evolve repository is required')
+  elif not None is options.retention and not str(options.retention).isdigit():
+    raise UsageError('history retention must be a number of entries')
+  elif (options.trace or options.cprofile) and not _writes_as_caller(forwarded):
+    raise UsageError(
+      'cannot write --trace or --cprofile output as the evolve user'
+    )
 
-def _log_session(start):
-  logger = logging.getLogger('sessions')
-  logger.setLevel(logging.INFO)
-  filehandler = logging.FileHandler(_SessionLog)
-  filehandler.setFormatter(logging.Formatter('%(message)s'))
-  logger.addHandler(filehandler)
-  logger.info('\t'.join([
-    str(start),
-    str(time.time()),
-    pwd.getpwuid(os.geteuid()).pw_name + '/' + str(os.geteuid()),
-    pwd.getpwuid(os.getuid()).pw_name + '/' + str(os.getuid()),
-    sys.executable,
-    '"%s"' % (' '.join([a.replace(' ', '\\ ') for a in sys.argv]))
-  ]))
+def _log_session(start, argv):
+  get_logger(_SessionLog, logging.INFO).info(
+    ' '.join([a.replace(' ', '\\ ') for a in ['evolve'] + argv]),
+    extra={ 'fields': OrderedDict([
+      ('start', start),
+      ('seconds', round(time.time() - start, 6)),
+      ('euser', pwd.getpwuid(os.geteuid()).pw_name + '/' + str(os.geteuid())),
+      ('executable', sys.executable),
+    ]) }
+  )
 
-if '__main__' == __name__:
+def main(argv, env=os.environ, forwarded=False):
+  '''
+    Runs a single evolve invocation, printing its output to stdout. Returns
+    the exit code for the invocation. forwarded is for invocations evolved
+    runs on behalf of a client.
+  '''
   success = 1
   logsession = False
   start = time.time()
-  options, args = _get_options()
-
-  from evolve.cli.evolvecli import UsageError
+  if not _writes_as_caller(forwarded):
+    env = dict([(k, v) for (k, v) in env.items() if not k in _OutputEnv])
+  options, args = _get_options(argv, env)
 
   try:
-    _validate_args(options, args)
+    _validate_args(options, args, forwarded)
+    if options.profile or options.trace or options.cprofile:
+      instrument.start(options.cprofile)
     logsession = True
+    set_lock_wait(options.wait, options.fifo)
+    set_history_retention(options.retention and int(options.retention))
     output = execute_command(args[0], options, *args[1:])
   except (UsageError, CommandError), ex:
     output = str(ex)
   else:
     success = 0
   finally: 
-    if logsession: _log_session(start)
+    if logsession: _log_session(start, argv)
+    if instrument.is_started():
+      report = instrument.stop(options.trace)
+      if options.profile: print >> sys.stderr, report
 
   if not None is output and not '' == output: print output
-  sys.exit(success)
+  return success
+
+if '__main__' == __name__:
+  # run through the importable module rather than __main__, so that commands
+  # importing evolvecli share its state (and exception types)
+  from evolve.cli.evolvecli import main
+  sys.exit(main(sys.argv[1:]))
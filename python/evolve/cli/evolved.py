@@ -0,0 +1,208 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+  The `evolve' daemon. Keeps an interpreter with the evolve modules and
+  repositories loaded, and executes the commands forwarded to it by the
+  bootstrapper over a local Unix socket, so that invocations don't pay for
+  interpreter startup and imports.
+
+  A request is a sequence of NUL-terminated fields: the protocol tag, the
+  client's uid and working directory, the number of environment variables
+  that follow and those variables (as NAME=value, from the _ForwardedEnv
+  the bootstrapper knows too), and then the command line arguments. The
+  client then shuts down its end for writing. Each request is served by a
+  forked child, so that one slow command doesn't hold up the rest and each
+  has its own working directory, streams and user. Replies are frames of a
+  one byte type and a four byte big-endian value: 'O' and 'E' carry that
+  many bytes of stdout and stderr, 'X' carries the exit code and ends the
+  reply, and 'F' tells the client to run the command in-process instead.
+'''
+
+__author__ = 'Will Leszczuk'
+
+import sys, os, socket, struct, signal, logging, traceback
+from SocketServer import UnixStreamServer, StreamRequestHandler, \
+  ForkingMixIn
+from optparse import OptionParser
+from evolve.shared.util import get_logger, set_user
+from evolve.shared.repo import get_repository, set_cache_size, after_fork
+from evolve.cli import evolvecli
+from evolve.cli.manifest import get_manifest
+
+SocketPath = '/var/run/evolve/evolved.sock'
+Protocol = 'evolve2'
+
+# variables the command sees; the rest of the client's environment (and
+# anything naming a path to write to) stays behind
+_ForwardedEnv = ['EVOLVE_REPO', 'EVOLVE_PROFILE', 'EVOLVE_HISTORY_RETENTION']
+
+# commands that need the client's terminal, streams or credentials
+_InProcessCommands = ['shell', 'init', 'batch', 'push', 'receive']
+_LogFilePath = evolvecli._LogPath + 'evolved.log'
+_SoPeerCred = getattr(socket, 'SO_PEERCRED', 17)
+_logger = None
+
+class _FrameWriter(object):
+  BufferSize = 64 * 1024
+
+  def __init__(self, stream, type):
+    self.stream = stream
+    self.type = type
+    self.buffer = []
+    self.size = 0
+
+  def write(self, data):
+    if isinstance(data, unicode): data = data.encode('utf-8')
+    self.buffer.append(data)
+    self.size += len(data)
+    if self.size >= _FrameWriter.BufferSize: self.flush()
+
+  def flush(self):
+    if 0 < self.size:
+      self.stream.write(struct.pack('!ci', self.type, self.size))
+      self.stream.write(''.join(self.buffer))
+      self.stream.flush()
+    self.buffer, self.size = [], 0
+
+class _RequestHandler(StreamRequestHandler):
+  def handle(self):
+    fields = self.rfile.read().split('\0')[:-1]
+    if 4 > len(fields) or Protocol != fields[0] or not fields[3].isdigit() \
+      or 4 + int(fields[3]) > len(fields):
+      _logger.error('malformed request')
+      return
+
+    uid, cwd, count = self._get_uid(int(fields[1])), fields[2], int(fields[3])
+    env = { }
+    for field in fields[4:4 + count]:
+      name, sep, value = field.partition('=')
+      if sep and name in _ForwardedEnv: env[name] = value
+    argv = fields[4 + count:]
+
+    if evolvecli.get_command_name(argv) in _InProcessCommands:
+      self.wfile.write(struct.pack('!ci', 'F', 0))
+      return
+
+    stdout = _FrameWriter(self.wfile, 'O')
+    stderr = _FrameWriter(self.wfile, 'E')
+    sys.stdout, sys.stderr = stdout, stderr
+    try:
+      set_user(uid)
+      try: os.chdir(cwd)
+      except OSError: os.chdir('/')
+      result = evolvecli.main(argv, env, forwarded=True)
+    except SystemExit, ex:
+      result = ex.code if isinstance(ex.code, int) else 1
+    except BaseException, ex:
+      traceback.print_exc(file=stderr)
+      result = 1
+    finally:
+      sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+      set_user(None)
+
+    stdout.flush()
+    stderr.flush()
+    self.wfile.write(struct.pack('!ci', 'X', result))
+
+  def _get_uid(self, claimed):
+    # the bootstrapper runs setuid as the daemon's user, so only requests
+    # from that user may act on behalf of another uid
+    pid, peeruid, peergid = struct.unpack(
+      '3i',
+      self.request.getsockopt(
+        socket.SOL_SOCKET, _SoPeerCred, struct.calcsize('3i')
+      )
+    )
+    return claimed if os.getuid() == peeruid else peeruid
+
+class _Server(ForkingMixIn, UnixStreamServer):
+  def finish_request(self, request, address):
+    # in the child, which leaves through os._exit and so skips the logging
+    # shutdown that would write out what it logged
+    after_fork()
+    try: UnixStreamServer.finish_request(self, request, address)
+    finally: logging.shutdown()
+
+  def handle_error(self, request, address):
+    _logger.error('error handling request:\n' + traceback.format_exc())
+
+def _warm(repos):
+  for name in get_manifest():
+    try: evolvecli.get_command(name)
+    except Exception, ex:
+      _logger.warning('failed to load command [%s]: %s' % (name, str(ex)))
+  for repo in repos:
+    get_repository(repo)._get_index()
+    _logger.info('loaded repository [%s]' % repo)
+
+def _bind(path):
+  if os.path.exists(path):
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try: probe.connect(path)
+    except socket.error: os.remove(path) # stale, left by a dead daemon
+    else: raise Exception('evolved already running at [%s]' % path)
+    finally: probe.close()
+  if not os.path.exists(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  server = _Server(path, _RequestHandler)
+  os.chmod(path, 0666)
+  return server
+
+def _get_options():
+  parser = OptionParser(
+    description=__doc__, usage='usage: %prog [OPTIONS]'
+  )
+  parser.add_option(
+    '-s', '--socket', action='store', dest='socket', default=SocketPath,
+    help='the path of the socket to listen on'
+  )
+  parser.add_option(
+    '-r', '--repo', action='append', dest='repos', default=[],
+    help='a repository to load at startup (may be repeated)'
+  )
+  parser.add_option(
+    '-m', '--cache-size', action='store', type='int', dest='cachesize',
+    default=None, help='how many metafiles to keep decoded in memory'
+  )
+  return parser.parse_args()[0]
+
+if '__main__' == __name__:
+  options = _get_options()
+  _logger = get_logger(_LogFilePath, logging.INFO)
+  server = _bind(options.socket)
+  if not None is options.cachesize: set_cache_size(options.cachesize)
+
+  def _stop(signum, frame): raise SystemExit(0)
+  signal.signal(signal.SIGTERM, _stop)
+
+  _warm(options.repos + [r for r in [os.getenv('EVOLVE_REPO')] if r])
+  _logger.info('listening on [%s]' % options.socket)
+  try: server.serve_forever()
+  except (SystemExit, KeyboardInterrupt): pass
+  finally:
+    server.server_close()
+    os.remove(options.socket)
+    _logger.info('stopped')
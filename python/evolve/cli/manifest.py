@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+  Builds and reads the command manifest: the names, usage lines and
+  documentation of the evolve commands, extracted from their source without
+  importing them. The manifest is written at install time; if it is missing
+  or older than the command sources it is rebuilt in memory.
+'''
+
+__author__ = 'Will Leszczuk'
+
+import os, ast, json
+
+ManifestFileName = 'manifest.json'
+_CommandsDir = \
+  os.path.join(os.path.dirname(os.path.abspath(__file__)), 'commands')
+_manifest = None
+
+def get_manifest():
+  '''
+    Returns a map of command name to { 'doc': ..., 'usage': ... }.
+  '''
+  global _manifest
+  if None is _manifest:
+    _manifest = _read(_CommandsDir)
+    if None is _manifest: _manifest = build(_CommandsDir)
+  return _manifest
+
+def build(commandsdir):
+  result = { }
+  for filename in _get_sources(commandsdir):
+    with open(os.path.join(commandsdir, filename), 'r') as source:
+      tree = ast.parse(source.read(), filename)
+    for node in tree.body:
+      if isinstance(node, ast.ClassDef) and 'Command' == node.name:
+        doc = ast.get_docstring(node, clean=False) or ''
+        result[filename[:-3]] = { 'doc': doc, 'usage': _get_usage(doc) }
+  return result
+
+def write(commandsdir):
+  manifest = build(commandsdir)
+  with open(os.path.join(commandsdir, ManifestFileName), 'w') as manifestfile:
+    json.dump(manifest, manifestfile, indent=2, sort_keys=True)
+  return manifest
+
+def _read(commandsdir):
+  path = os.path.join(commandsdir, ManifestFileName)
+  try: built = os.path.getmtime(path)
+  except OSError: return None
+
+  sources = _get_sources(commandsdir)
+  if any(os.path.getmtime(os.path.join(commandsdir, s)) > built
+         for s in sources):
+    return None
+
+  with open(path, 'r') as manifestfile:
+    manifest = json.load(manifestfile)
+  if sorted(manifest.keys()) != sorted(s[:-3] for s in sources): return None
+
+  return dict(
+    (str(name), dict((str(k), str(v)) for k, v in entry.iteritems()))
+      for name, entry in manifest.iteritems()
+  )
+
+def _get_sources(commandsdir):
+  return [
+    f for f in os.listdir(commandsdir)
+      if f.endswith('.py') and not f.startswith('_') and not f.startswith('.')
+  ]
+
+def _get_usage(doc):
+  for line in doc.splitlines():
+    if line.strip().startswith('usage:'): return line.strip()[6:].strip()
+  return ''
+
+if '__main__' == __name__:
+  print 'wrote manifest for %d commands' % len(write(_CommandsDir))
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+'''
+  The dependencies between the releases and rlinks in an `evolve'
+  repository, as an in-memory graph. Both directions are kept as adjacency
+  lists, so the dependencies of a node and the nodes that depend on it are
+  found in time proportional to the answer. An rlink depends on its target.
+'''
+
+__author__ = 'Will Leszczuk'
+
+from evolve.shared.errors import RepoError
+
+class DependencyGraph(object):
+  def __init__(self, edges=()):
+    self.dependencies, self.dependents = {}, {}
+    for path, dependency in edges: self.add(path, dependency)
+
+  def add(self, path, dependency):
+    self.dependencies.setdefault(path, set()).add(dependency)
+    self.dependents.setdefault(dependency, set()).add(path)
+
+  def remove(self, path, dependency):
+    self.dependencies.get(path, set()).discard(dependency)
+    self.dependents.get(dependency, set()).discard(path)
+
+  def replace(self, path, dependencies):
+    for dependency in list(self.dependencies.get(path, ())):
+      self.remove(path, dependency)
+    for dependency in dependencies: self.add(path, dependency)
+
+  def get_dependencies(self, path, transitive=False):
+    '''
+      Returns what path depends on: directly, sorted by name, or
+      transitively, with each dependency ahead of its own dependents.
+    '''
+    if not transitive: return sorted(self.dependencies.get(path, ()))
+    return [p for p in self.get_order([path]) if p != path]
+
+  def get_dependents(self, path, transitive=False):
+    '''
+      Returns what depends on path, directly or transitively, sorted by name.
+    '''
+    if not transitive: return sorted(self.dependents.get(path, ()))
+    found, pending = set(), [path]
+    while pending:
+      for dependent in self.dependents.get(pending.pop(), ()):
+        if not dependent in found:
+          found.add(dependent)
+          pending.append(dependent)
+    found.discard(path)
+    return sorted(found)
+
+  def find_cycle(self, paths=None):
+    '''
+      Returns the first cycle reachable from paths (everything by default)
+      as a list of paths that starts and ends with the same one, or None.
+    '''
+    try: self.get_order(self.dependencies.keys() if None is paths else paths)
+    except _Cycle, e: return e.cycle
+    return None
+
+  def get_order(self, paths):
+    '''
+      Returns paths and everything they depend on, transitively, with each
+      dependency ahead of its dependents. Raises RepoError on a cycle.
+    '''
+    order, done, active, onstack = [], set(), [], set()
+    for root in sorted(paths):
+      if root in done: continue
+      # an explicit stack of (path, remaining dependencies) rather than
+      # recursion, since chains can be longer than the interpreter allows
+      stack = [(root, iter(self.get_dependencies(root)))]
+      active.append(root)
+      onstack.add(root)
+      while stack:
+        path, remaining = stack[-1]
+        for dependency in remaining:
+          if dependency in done: continue
+          if dependency in onstack:
+            raise _Cycle(active[active.index(dependency):] + [dependency])
+          stack.append((dependency, iter(self.get_dependencies(dependency))))
+          active.append(dependency)
+          onstack.add(dependency)
+          break
+        else:
+          stack.pop()
+          onstack.discard(active.pop())
+          done.add(path)
+          order.append(path)
+    return order
+
+  def get_waves(self, paths, members=None):
+    '''
+      Splits paths and everything they depend on into waves, where nothing
+      in a wave depends on anything in the same wave or a later one. Only
+      the paths in members (all of them by default) are placed in waves;
+      the rest are passed through, so they order their dependents without
+      taking up a wave of their own.
+    '''
+    levels, waves = {}, []
+    for path in self.get_order(paths):
+      level = max(
+        [levels[d] for d in self.dependencies.get(path, ())] or [-1]
+      )
+      if None is members or path in members:
+        level += 1
+        while len(waves) <= level: waves.append([])
+        waves[level].append(path)
+      levels[path] = level
+    return waves
+
+class _Cycle(RepoError):
+  def __init__(self, cycle):
+    RepoError.__init__(self, 'dependency cycle: %s' % ' -> '.join(cycle))
+    self.cycle = cycle
@@ -0,0 +1,231 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+  A consolidated index of the metadata in an `evolve' repository, kept in a
+  single SQLite database under the repository root so that listings and
+  lookups don't have to visit one metafile per node. Dependencies are kept
+  in a table of their own, along with a generation number that changes
+  whenever they do.
+'''
+
+__author__ = 'Will Leszczuk'
+
+import os, sqlite3
+
+class RepoIndex(object):
+  IndexDirName = '.evolve'
+  IndexFileName = 'index.db'
+  Version = '2'
+
+  _Schema = [
+    '''
+      CREATE TABLE IF NOT EXISTS nodes (
+        path        TEXT PRIMARY KEY,
+        parent      TEXT,
+        name        TEXT NOT NULL,
+        type        TEXT NOT NULL,
+        deployed    INTEGER NOT NULL DEFAULT 0,
+        target      TEXT,
+        lastmoduser TEXT,
+        lastmodtime REAL
+      )
+    ''',
+    'CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent, name)',
+    '''
+      CREATE TABLE IF NOT EXISTS deps (
+        path        TEXT NOT NULL,
+        dependency  TEXT NOT NULL,
+        PRIMARY KEY (path, dependency)
+      )
+    ''',
+    'CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)',
+  ]
+
+  _Columns = \
+    'path, parent, name, type, deployed, target, lastmoduser, lastmodtime'
+
+  def __init__(self, root):
+    indexdir = os.path.join(root, RepoIndex.IndexDirName)
+    if not os.path.exists(indexdir): os.makedirs(indexdir)
+    self.path = os.path.join(indexdir, RepoIndex.IndexFileName)
+    self.conn = sqlite3.connect(self.path, timeout=30)
+    self.conn.row_factory = sqlite3.Row
+    self.conn.text_factory = str
+    # readers see the last committed state rather than waiting on writers
+    self.conn.execute('PRAGMA journal_mode=WAL')
+    with self.conn:
+      for statement in RepoIndex._Schema: self.conn.execute(statement)
+
+  def close(self):
+    self.conn.close()
+
+  def is_built(self):
+    row = self.conn.execute(
+      'SELECT value FROM info WHERE key = ?', ('version',)
+    ).fetchone()
+    return not None is row and RepoIndex.Version == row['value']
+
+  def rebuild(self, entries):
+    '''
+      Replaces the contents of the index with the supplied (path, metafile)
+      pairs, in a single transaction.
+    '''
+    deps = []
+    def _rows():
+      for path, meta in entries:
+        deps.extend((path, d) for d in RepoIndex._get_deps(meta) or [])
+        yield RepoIndex._to_row(path, meta)
+
+    with self.conn:
+      self.conn.execute('DELETE FROM nodes')
+      self.conn.execute('DELETE FROM deps')
+      self.conn.executemany(
+        'INSERT INTO nodes (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+          % RepoIndex._Columns,
+        _rows()
+      )
+      self.conn.executemany('INSERT INTO deps VALUES (?, ?)', deps)
+      self._bump_generation()
+      self.conn.execute(
+        'INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)',
+        ('version', RepoIndex.Version)
+      )
+
+  def update(self, *entries):
+    '''
+      Adds or replaces the rows for the supplied (path, metafile) pairs, in a
+      single transaction.
+    '''
+    rows = [RepoIndex._to_row(path, meta) for path, meta in entries]
+    with self.conn:
+      # an rlink's target counts as one of its dependencies
+      changed = False
+      for row in rows:
+        if 'rlink' != row[3]: continue
+        old = self.get(row[0])
+        changed = changed or None is old or row[5] != old['target']
+      self.conn.executemany(
+        'INSERT OR REPLACE INTO nodes (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+          % RepoIndex._Columns,
+        rows
+      )
+      for path, meta in entries:
+        deps = RepoIndex._get_deps(meta)
+        if None is deps or sorted(set(deps)) == self.get_dependencies(path):
+          continue
+        self.conn.execute('DELETE FROM deps WHERE path = ?', (path,))
+        self.conn.executemany(
+          'INSERT OR IGNORE INTO deps VALUES (?, ?)', [(path, d) for d in deps]
+        )
+        changed = True
+      if changed: self._bump_generation()
+
+  def remove(self, path):
+    with self.conn:
+      self.conn.execute(
+        'DELETE FROM nodes WHERE path = ? OR substr(path, 1, ?) = ?',
+        (path, len(path) + 1, path + '/')
+      )
+      self.conn.execute(
+        'DELETE FROM deps WHERE path = ? OR substr(path, 1, ?) = ?',
+        (path, len(path) + 1, path + '/')
+      )
+      self._bump_generation()
+
+  def get(self, path):
+    return self.conn.execute(
+      'SELECT %s FROM nodes WHERE path = ?' % RepoIndex._Columns, (path,)
+    ).fetchone()
+
+  def get_children(self, path):
+    return self.conn.execute(
+      'SELECT %s FROM nodes WHERE parent = ? ORDER BY name'
+        % RepoIndex._Columns,
+      (path,)
+    ).fetchall()
+
+  def get_subtree(self, path):
+    '''
+      Returns every row at or beneath path. The root ('') matches everything.
+    '''
+    if '' == path:
+      return self.conn.execute(
+        'SELECT %s FROM nodes' % RepoIndex._Columns
+      ).fetchall()
+    return self.conn.execute(
+      'SELECT %s FROM nodes WHERE path = ? OR substr(path, 1, ?) = ?'
+        % RepoIndex._Columns,
+      (path, len(path) + 1, path + '/')
+    ).fetchall()
+
+  def get_dependencies(self, path):
+    return [row['dependency'] for row in self.conn.execute(
+      'SELECT dependency FROM deps WHERE path = ? ORDER BY dependency', (path,)
+    )]
+
+  def get_edges(self):
+    '''
+      Returns every (path, dependency) pair, including the implicit
+      dependency of each rlink on its target.
+    '''
+    return self.conn.execute(
+      '''
+        SELECT path, dependency FROM deps
+        UNION SELECT path, target FROM nodes WHERE type = 'rlink'
+      '''
+    ).fetchall()
+
+  def get_generation(self):
+    row = self.conn.execute(
+      'SELECT value FROM info WHERE key = ?', ('generation',)
+    ).fetchone()
+    return 0 if None is row else int(row['value'])
+
+  def _bump_generation(self):
+    self.conn.execute(
+      'INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)',
+      ('generation', self.get_generation() + 1)
+    )
+
+  @staticmethod
+  def _get_deps(meta):
+    # None where the metafile's dependencies weren't loaded (or it can't
+    # have any), so they're left as they are
+    try: return meta.dependencies
+    except AttributeError: return None
+
+  @staticmethod
+  def _to_row(path, meta):
+    return (
+      path,
+      None if '' == path else os.path.dirname(path),
+      path.split('/')[-1],
+      meta.get_type(),
+      1 if getattr(meta, 'deployed', False) else 0,
+      getattr(meta, 'target', None),
+      meta.lastmoduser,
+      meta.lastmodtime,
+    )
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+  Timing of the phases of an evolve invocation. Code marks a phase with
+  `with span(name):' or the @timed(name) decorator; until start() is called
+  that costs a single check. While recording, the time spent in each span is
+  added up by name, both in total and less the spans nested in it, and kept
+  as an event for the trace file. Spans from several threads are recorded
+  side by side.
+'''
+
+__author__ = 'Will Leszczuk'
+
+import os, time, json, threading
+from functools import wraps
+
+_recorder = None
+
+class _NoSpan(object):
+  def __enter__(self): pass
+  def __exit__(self, type, value, traceback): pass
+
+_nospan = _NoSpan()
+
+class _Span(object):
+  def __init__(self, recorder, name, fields):
+    self.recorder = recorder
+    self.name = name
+    self.fields = fields
+    self.nested = 0
+
+  def __enter__(self):
+    self.recorder.get_stack().append(self)
+    self.start = time.time()
+
+  def __exit__(self, type, value, traceback):
+    self.end = time.time()
+    stack = self.recorder.get_stack()
+    stack.pop()
+    if stack: stack[-1].nested += self.end - self.start
+    self.recorder.add(self)
+
+class _Recorder(object):
+  def __init__(self, profile):
+    self.start = time.time()
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.totals = { }
+    self.events = []
+    self.profiler = None
+    if not None is profile:
+      import cProfile
+      self.profiler = cProfile.Profile()
+      self.profiler.enable()
+    self.profile = profile
+
+  def get_stack(self):
+    try: return self.local.stack
+    except AttributeError:
+      self.local.stack = []
+      return self.local.stack
+
+  def add(self, span):
+    elapsed = span.end - span.start
+    with self.lock:
+      totals = self.totals.setdefault(span.name, [0, 0, 0])
+      totals[0] += 1
+      totals[1] += elapsed
+      totals[2] += elapsed - span.nested
+      self.events.append((span, threading.current_thread().ident))
+
+def start(profile=None):
+  '''
+    Starts recording spans, and running cProfile (for the calling thread)
+    if profile names a file for its stats.
+  '''
+  global _recorder
+  _recorder = _Recorder(profile)
+
+def is_started():
+  return not None is _recorder
+
+def stop(trace=None):
+  '''
+    Stops recording, writing the cProfile stats and, if trace names a file,
+    the spans in Chrome's trace event format. Returns the breakdown of where
+    the time went, one line per span name with the longest first.
+  '''
+  global _recorder
+  recorder, _recorder = _recorder, None
+  if None is recorder: return ''
+  wall = time.time() - recorder.start
+  if not None is recorder.profiler:
+    recorder.profiler.disable()
+    recorder.profiler.dump_stats(recorder.profile)
+  if not None is trace: _write_trace(recorder, trace)
+
+  lines = ['  %-32s %6s %10s %10s %7s' % (
+    'span', 'count', 'total', 'self', 'wall'
+  )]
+  for name, (count, total, own) in sorted(
+    recorder.totals.iteritems(), key=lambda item: -item[1][1]
+  ):
+    lines.append('  %-32s %6d %9.3fs %9.3fs %6.1f%%' % (
+      name, count, total, own, 100 * total / wall if wall else 0
+    ))
+  lines.append('  %-32s %6s %9.3fs' % ('(wall)', '', wall))
+  return '\n'.join(lines)
+
+def span(name, **fields):
+  '''
+    Returns a context manager recording the time spent in it as a span
+    called name. fields are kept with the span in the trace.
+  '''
+  if None is _recorder: return _nospan
+  return _Span(_recorder, name, fields)
+
+def timed(name):
+  '''
+    Decorates a function so that each call is recorded as a span.
+  '''
+  def _decorate(fn):
+    @wraps(fn)
+    def _timed(*args, **kwargs):
+      if None is _recorder: return fn(*args, **kwargs)
+      with _Span(_recorder, name, { }): return fn(*args, **kwargs)
+    return _timed
+  return _decorate
+
+def _write_trace(recorder, path):
+  pid = os.getpid()
+  events = [
+    {
+      'name': span.name, 'ph': 'X', 'pid': pid, 'tid': tid,
+      'ts': int((span.start - recorder.start) * 1000000),
+      'dur': int((span.end - span.start) * 1000000),
+      'args': span.fields,
+    }
+    for span, tid in recorder.events
+  ]
+  with open(path, 'w') as tracefile:
+    json.dump({ 'traceEvents': events }, tracefile, default=str)
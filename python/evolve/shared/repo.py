@@ -29,12 +29,23 @@
 
 __author__ = 'Will Leszczuk'
 
-import logging, os, re, fcntl, time, pwd
-from cPickle import dump, load
-from evolve.shared.util import get_logger, do_or_die
-
-class RepoError(Exception): pass
-class ArgumentError(RepoError): pass
+import logging, os, re, fcntl, time, json, stat, errno, socket, fnmatch
+import threading, subprocess
+from collections import OrderedDict
+from cPickle import load
+from evolve.shared.util import get_logger, get_user, do_or_die, \
+  imap_parallel, iwalk_parallel
+from evolve.shared.index import RepoIndex
+from evolve.shared.deps import DependencyGraph
+from evolve.shared.instrument import span, timed
+from evolve.shared.errors import RepoError, ArgumentError
+from evolve.shared import settings
+from evolve.shared.settings import set_lock_wait, set_history_retention
+from evolve.shared.sync import sync_tree, replace_symlink, touch_changed, \
+  hash_file, copy_file, TempSuffix
+from evolve.shared.store import ObjectStore
+from evolve.shared.stream import FrameStream, StreamError, pack_chunk, \
+  unpack_chunk
 
 # TODO: chmod on src directory needs to be -R
 # TODO: should bin just be a symlink to the build artifact directory instead?
@@ -42,34 +53,221 @@ class ArgumentError(RepoError): pass
 # TODO: consolidate validations
 # TODO: vefify locking in new commands
 # TODO: logging!
-# TODO: ability to push to another repository (dev/prod)
-# TODO: to deploy, all dependencies must be deployed
 # TODO: can only set rlink to deployed releases
 # TODO: can only push rlinks (and pull the target) (--deploy-all-dependencies flag?)
-# TODO: dep graph
 # TODO: clone dependencies from another release
 # TODO: unlock command? (leaning against)
 
+class _MetaFileCache(object):
+  '''
+    A bounded LRU cache of decoded metafiles, keyed by path. Entries hold
+    the header and (once something has read it) body dicts rather than
+    metafile objects, so callers can't modify each other's copies. An entry
+    is only used while the file's (mtime, size, inode) still match those it
+    was read with - as metafiles are replaced by rename, any write gives the
+    file a new inode. Shared between threads.
+  '''
+
+  DefaultSize = 1024
+
+  def __init__(self, size=DefaultSize):
+    self.size = size
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  @staticmethod
+  def get_key(stat):
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+  def get(self, metapath, key):
+    with self.lock:
+      entry = self.entries.pop(metapath, None)
+      if None is entry or key != entry[0]:
+        self.misses += 1
+        return None
+      self.entries[metapath] = entry # now the most recently used
+      self.hits += 1
+      return entry
+
+  def put(self, metapath, key, header, body=None):
+    with self.lock:
+      self.entries.pop(metapath, None)
+      if 0 >= self.size: return
+      self.entries[metapath] = (key, header, body)
+      while len(self.entries) > self.size: self.entries.popitem(False)
+
+  def put_body(self, metapath, key, body):
+    with self.lock:
+      entry = self.entries.get(metapath)
+      if not None is entry and key == entry[0]:
+        self.entries[metapath] = (key, entry[1], body)
+
+_cache = _MetaFileCache()
+
+def set_cache_size(size):
+  '''
+    Sets how many metafiles this process keeps decoded in memory.
+  '''
+  global _cache
+  _cache = _MetaFileCache(size)
+
+def get_cache_stats():
+  '''
+    Returns the (hits, misses, entries) of the metafile cache.
+  '''
+  return _cache.hits, _cache.misses, len(_cache.entries)
+
+def _copy_body(body):
+  # the lists are the only parts of a body that get modified in place
+  return dict(
+    (k, list(v) if isinstance(v, list) else v) for k, v in body.iteritems()
+  )
+
 class _RepoMetaFile(object):
+  '''
+    Metafiles are stored as three lines: a magic/version line, a fixed JSON
+    header (type, deployed flag, last modification and rlink target) and a
+    JSON body holding the variable-length fields (children, dependencies,
+    history). The body is only read when one of its fields is first accessed,
+    so header-only callers (descriptors, type checks) never deserialize it.
+    Files written by older versions are pickles, and are still readable.
+    Loaded metafiles go through the process' _MetaFileCache.
+  '''
+
   RepoMetaFileName = '.evolverepo'
+  Magic = 'evolve-meta'
+  Version = 2
+  BodyFields = []
 
   @staticmethod
+  @timed('metafile.load')
   def load(path):
-    with open(_RepoMetaFile._get_metapath(path), 'r') as repofile:
-      result = load(repofile)
+    metapath = _RepoMetaFile._get_metapath(path)
+    try: key = _MetaFileCache.get_key(os.stat(metapath))
+    except OSError, ex:
+      # callers expect the IOError that opening a missing metafile raises
+      raise IOError(ex.errno, ex.strerror, metapath)
+    entry = _cache.get(metapath, key)
+    if not None is entry:
+      return _RepoMetaFile._from_cache(metapath, *entry)
+
+    with open(metapath, 'r') as repofile:
+      magic = repofile.readline().split()
+      if 2 != len(magic) or _RepoMetaFile.Magic != magic[0]:
+        repofile.seek(0)
+        return _RepoMetaFile._load_legacy(repofile)
+      if int(magic[1]) > _RepoMetaFile.Version:
+        raise RepoError('unsupported metafile version at [%s]' % path)
+      header = _decode(json.loads(repofile.readline()))
+      # the file may have been replaced since the stat
+      key = _MetaFileCache.get_key(os.fstat(repofile.fileno()))
+    _cache.put(metapath, key, header)
+    return _RepoMetaFile._from_cache(metapath, key, header, None)
+
+  @staticmethod
+  def _from_cache(metapath, key, header, body):
+    result = object.__new__(_MetaFileTypes[header['type']])
+    result._set_header(header)
+    result._version = _RepoMetaFile.Version
+    if None is body:
+      result._metapath = metapath
+      result._metakey = key
+    else:
+      result.__dict__.update(_copy_body(body))
+    return result
+
+  @staticmethod
+  def _load_legacy(repofile):
+    result = load(repofile)
     if not hasattr(result, 'lastmoduser'): result.lastmoduser = 'unavailable'
     if not hasattr(result, 'lastmodtime'): result.lastmodtime = 0
+    if _RepoRlink.Type == result.get_type() and not hasattr(result, 'history'):
+      result.history = []
+    result._version = 1
     return result
 
+  @staticmethod
+  def get_version(path):
+    with open(_RepoMetaFile._get_metapath(path), 'r') as repofile:
+      magic = repofile.readline().split()
+    if 2 != len(magic) or _RepoMetaFile.Magic != magic[0]: return 1
+    return int(magic[1])
+
   @staticmethod
   def exists(path):
     return os.path.exists(_RepoMetaFile._get_metapath(path))
 
   def save(self, path):
-    self.lastmoduser = pwd.getpwuid(os.getuid()).pw_name
+    self.lastmoduser = get_user()[0]
     self.lastmodtime = time.time()
-    with open(_RepoMetaFile._get_metapath(path), 'w') as repofile:
-      dump(self, repofile)
+    self.write(path)
+
+  @timed('metafile.save')
+  def write(self, path):
+    '''
+      Writes the metafile in the current format without touching the last
+      modification fields. The new file replaces the old one in a single
+      rename, so readers never see a partially written metafile.
+    '''
+    header = {
+      'type': self.get_type(),
+      'deployed': getattr(self, 'deployed', False),
+      'lastmoduser': self.lastmoduser,
+      'lastmodtime': self.lastmodtime,
+      'target': getattr(self, 'target', None),
+    }
+    body = json.dumps(
+      dict((f, getattr(self, f)) for f in type(self).BodyFields),
+      sort_keys=True
+    )
+    metapath = _RepoMetaFile._get_metapath(path)
+    with open(metapath + TempSuffix, 'w') as repofile:
+      repofile.write('%s %d\n' % (_RepoMetaFile.Magic, _RepoMetaFile.Version))
+      repofile.write(json.dumps(header, sort_keys=True) + '\n')
+      repofile.write(body + '\n')
+      repofile.flush()
+      os.fsync(repofile.fileno())
+      key = _MetaFileCache.get_key(os.fstat(repofile.fileno()))
+    os.rename(metapath + TempSuffix, metapath)
+    # decoded again so the cache holds what a load would have produced
+    _cache.put(metapath, key, header, _decode(json.loads(body)))
+
+  def _set_header(self, header):
+    self.lastmoduser = header['lastmoduser']
+    self.lastmodtime = header['lastmodtime']
+    self.deployed = bool(header['deployed'])
+    self.target = header['target']
+
+  def __getattr__(self, name):
+    # only reached for attributes that haven't been set, i.e. body fields of
+    # a metafile whose body hasn't been read yet
+    if name in type(self).BodyFields and '_metapath' in self.__dict__:
+      metapath = self.__dict__.pop('_metapath')
+      with span('metafile.load_body'), open(metapath, 'r') as repofile:
+        repofile.readline()
+        repofile.readline()
+        body = _decode(json.loads(repofile.readline()))
+        key = _MetaFileCache.get_key(os.fstat(repofile.fileno()))
+      if key == self.__dict__.pop('_metakey'):
+        _cache.put_body(metapath, key, body)
+        body = _copy_body(body)
+      # body fields assigned before the body was read keep their new values
+      for field, value in body.iteritems():
+        self.__dict__.setdefault(field, value)
+      return self.__dict__[name]
+    raise AttributeError(name)
+
+  @staticmethod
+  def from_index(row):
+    '''
+      Reconstructs a metafile from an index row. Only the fields kept in the
+      index are populated - children are available from the index itself.
+    '''
+    result = object.__new__(_MetaFileTypes[row['type']])
+    result._set_header(row)
+    return result
 
   @staticmethod
   def _get_metapath(path):
@@ -86,6 +284,7 @@ class _RepoMetaFile(object):
 
 class _RepoRoot(_RepoMetaFile):
   Type = 'repository root'
+  BodyFields = ['projects']
 
   def __init__(self):
     self.projects = []
@@ -100,6 +299,7 @@ class _RepoRoot(_RepoMetaFile):
 
 class _RepoProject(_RepoMetaFile):
   Type = 'project'
+  BodyFields = ['projects', 'releases']
 
   def __init__(self):
     self.projects = []
@@ -117,6 +317,7 @@ class _RepoProject(_RepoMetaFile):
 
 class _RepoRelease(_RepoMetaFile):
   Type = 'release'
+  BodyFields = ['dependencies']
 
   def __init__(self):
     self.deployed = False
@@ -135,7 +336,14 @@ class _RepoRelease(_RepoMetaFile):
     ]
 
 class _RepoRlink(_RepoMetaFile):
+  '''
+    An rlink's history of targets lives in an _RlinkHistory beside its
+    metafile. The metafile's own history field is only filled in by older
+    versions of evolve, and is moved out on the next update.
+  '''
+
   Type = 'rlink'
+  BodyFields = ['dependencies', 'history']
 
   def __init__(self, target):
     self.target = target
@@ -154,38 +362,320 @@ class _RepoRlink(_RepoMetaFile):
       ('Target', self.target.split('/')[-1])
     ]
 
-  def update(self, target):
-    if not hasattr(self, 'history'): self.history = []
-    self.history = [(self.target, self.lastmoduser, self.lastmodtime)] \
-      + self.history
+  def update(self, target, rollback=False):
+    '''
+      Retargets the rlink, returning the (target, user, time) entries to add
+      to its history, oldest first. If this is a rollback, the entry for the
+      target it leaves has a fourth field, _RlinkHistory.RolledBack.
+    '''
+    entry = (self.target, self.lastmoduser, self.lastmodtime)
+    if rollback: entry += (_RlinkHistory.RolledBack,)
+    entries = list(reversed(self.history or [])) + [entry]
+    self.history = []
     self.target = target
-
-  def get_history(self):
-    return self.history or []
+    return entries
+
+class _RlinkHistory(object):
+  '''
+    The targets an rlink has had, as an append-only log of JSON lines beside
+    its metafile, oldest first, so an update appends one line rather than
+    rewriting the lot. Reads start from the end of the log and stop once
+    they have what was asked for. Whenever the log grows past another
+    CheckBytes, it is compacted to its newest entries (Retention, unless
+    set_history_retention says otherwise) if it holds more than twice as
+    many.
+  '''
+
+  HistoryFileName = '.evolvehistory'
+  RolledBack = 'rolled back'
+  Retention = 1000
+  CheckBytes = 64 * 1024
+  _BlockSize = 8192
+
+  def __init__(self, rlinkpath):
+    self.path = os.path.join(rlinkpath, _RlinkHistory.HistoryFileName)
+
+  def append(self, *entries):
+    data = ''.join([json.dumps(list(entry)) + '\n' for entry in entries])
+    fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+      os.write(fd, data)
+      os.fsync(fd)
+      size = os.fstat(fd).st_size
+    finally:
+      os.close(fd)
+
+    checks = _RlinkHistory.CheckBytes
+    retention = settings.history_retention or _RlinkHistory.Retention
+    if size // checks != (size - len(data)) // checks \
+      and 2 * retention < len(self.read(2 * retention + 1)):
+      self.compact(retention)
+
+  def read(self, limit=None, since=None):
+    '''
+      Returns (target, user, time) entries newest first: at most limit of
+      them, and none from before since.
+    '''
+    entries = []
+    for entry in self._read_back():
+      if (not None is limit and len(entries) >= limit) \
+        or (not None is since and entry[2] < since):
+        break
+      entries.append(entry)
+    return entries
+
+  def compact(self, keep):
+    '''
+      Drops all but the newest keep entries, returning how many went.
+    '''
+    entries = self.read()
+    if len(entries) <= keep: return 0
+    temppath = self.path + TempSuffix
+    with open(temppath, 'w') as log:
+      for entry in reversed(entries[:keep]):
+        log.write(json.dumps(list(entry)) + '\n')
+      log.flush()
+      os.fsync(log.fileno())
+    os.rename(temppath, self.path)
+    return len(entries) - keep
+
+  def _read_back(self):
+    try: log = open(self.path, 'rb')
+    except IOError, ex:
+      if errno.ENOENT == ex.errno: return
+      raise
+    with log:
+      log.seek(0, os.SEEK_END)
+      end, partial = log.tell(), ''
+      while 0 < end:
+        start = max(0, end - _RlinkHistory._BlockSize)
+        log.seek(start)
+        lines = (log.read(end - start) + partial).split('\n')
+        # the first line may carry on in the block before
+        partial = lines.pop(0) if 0 < start else ''
+        for line in reversed(lines):
+          if line: yield tuple(_decode(json.loads(line)))
+        end = start
+
+def _is_relative(path):
+  # a normalized relative path, which can't leave the directory it's joined to
+  return isinstance(path, str) and '' != path and not '\0' in path \
+    and not os.path.isabs(path) and os.path.normpath(path) == path \
+    and not [p for p in path.split('/') if p in ('.', '..')]
+
+def _decode(value):
+  # json hands back unicode; the rest of evolve deals in plain strings
+  if isinstance(value, unicode): return value.encode('utf-8')
+  if isinstance(value, list): return [_decode(v) for v in value]
+  if isinstance(value, dict):
+    return dict((_decode(k), _decode(v)) for k, v in value.iteritems())
+  return value
+
+def _mark_last(items):
+  for i in range(len(items)): yield items[i], i == len(items) - 1
+
+_MetaFileTypes = dict(
+  (cls.Type, cls) for cls in [_RepoRoot, _RepoProject, _RepoRelease, _RepoRlink]
+)
+
+def _get_start_time(pid):
+  # in clock ticks since boot; None where there's no /proc
+  try:
+    with open('/proc/%d/stat' % pid, 'r') as statfile: fields = statfile.read()
+  except IOError, ex:
+    return None
+  return fields[fields.rfind(')') + 2:].split()[19]
+
+def _is_running(pid, host=None, starttime=None):
+  '''
+    Returns whether the process pid (started at starttime, as returned by
+    _get_start_time) is still running. Processes on other hosts are assumed
+    to be.
+  '''
+  if not None is host and socket.gethostname() != host: return True
+  try: os.kill(pid, 0)
+  except OSError, ex:
+    if errno.ESRCH == ex.errno: return False
+  # a different start time means the pid has been reused
+  current = _get_start_time(pid)
+  return None is starttime or None is current or starttime == current
 
 class _RepoLock(object):
+  '''
+    A lock on a repository node: shared for readers, which don't exclude each
+    other, or exclusive for writers. The lock is an flock on a file kept in
+    the node, so the kernel drops it if its holder dies. A busy node is
+    polled with exponential backoff until the timeout (by default, the one
+    given to set_lock_wait) runs out. With fifo, each waiter leaves a ticket
+    file in the node and only tries for the lock once its ticket is the
+    oldest one left, so waiters are served in order of arrival. Shared locks
+    wait at least ReaderWait seconds, as writers only hold a node briefly.
+
+    Exclusive holders record their pid, host and start time in the lock
+    file. The kernel releases the lock when its holder dies, unless a child
+    process inherited the descriptor. If a busy lock's recorded owner is no
+    longer running, the acquirer replaces the lock file and carries on.
+  '''
+
   class LockError(Exception): pass
 
   RepoLockFileName = '.evolvelock'
+  TicketPrefix = '.evolvewait.'
+  MinBackoff = 0.01
+  MaxBackoff = 0.25
+  ReaderWait = 5
 
-  def __init__(self, path, steal=False):
+  def __init__(self, path, shared=False, timeout=None, fifo=None, logger=None):
     self.path = path
-    self.steal = steal
+    self.shared = shared
+    if None is timeout:
+      timeout = max(
+        settings.lock_wait[0], _RepoLock.ReaderWait if shared else 0
+      )
+    self.timeout = timeout
+    self.fifo = settings.lock_wait[1] if None is fifo else fifo
+    self.logger = logger
+    self.waited = 0
 
+  @timed('lock.acquire')
   def __enter__(self):
-    lockpath = self._get_lockpath()
-    if not self.steal and os.path.exists(lockpath): self._throw_busy()
-    self.lockfile = open(lockpath, 'w')
-
-    try: fcntl.flock(self.lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-    except IOError, ex:
-      self.lockfile.close()
-      self._throw_busy()
+    start = time.time()
+    ticket = self._take_ticket() if self.fifo and 0 < self.timeout else None
+    try:
+      backoff = _RepoLock.MinBackoff
+      while not (
+        (None is ticket or self._is_next(ticket)) and self._try_lock()
+      ):
+        remaining = start + self.timeout - time.time()
+        if 0 >= remaining: self._throw_busy()
+        time.sleep(min(backoff, remaining))
+        backoff = min(2 * backoff, _RepoLock.MaxBackoff)
+    finally:
+      # a waiter that took our ticket for stale may have cleared it already
+      if not None is ticket:
+        try: os.remove(ticket)
+        except OSError, ex:
+          if errno.ENOENT != ex.errno: raise
+
+    self.waited = time.time() - start
+    if backoff > _RepoLock.MinBackoff and not None is self.logger:
+      self.logger.info(
+        'waited [%.3fs] for lock on [%s]' % (self.waited, self.path)
+      )
     # no return - don't want anybody messing with the lock object
 
   def __exit__(self, type, value, traceback):
+    if not self.shared: self.lockfile.truncate(0)
     self.lockfile.close()
-    os.remove(self._get_lockpath())
+
+  @staticmethod
+  def get_owner(path):
+    '''
+      Returns the (pid, host, starttime, locktime) recorded by the last
+      exclusive holder of the lock at path, or None if it was released.
+    '''
+    try:
+      with open(os.path.join(path, _RepoLock.RepoLockFileName), 'r') as f:
+        fields = f.read().split()
+    except IOError, ex:
+      return None
+    if 4 != len(fields): return None
+    return (
+      int(fields[0]), fields[1], None if '-' == fields[2] else fields[2],
+      float(fields[3])
+    )
+
+  def _try_lock(self, takeover=True):
+    lockpath = self._get_lockpath()
+    lockfile = open(lockpath, 'a')
+    # children (rsync, cp) mustn't inherit the lock and outlive us with it
+    fcntl.fcntl(
+      lockfile.fileno(), fcntl.F_SETFD,
+      fcntl.fcntl(lockfile.fileno(), fcntl.F_GETFD) | fcntl.FD_CLOEXEC
+    )
+
+    try:
+      fcntl.flock(
+        lockfile.fileno(),
+        (fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX) | fcntl.LOCK_NB
+      )
+    except IOError, ex:
+      lockfile.close()
+      owner = _RepoLock.get_owner(self.path)
+      if takeover and not None is owner and not _is_running(*owner[:3]):
+        self._take_over(owner)
+        return self._try_lock(False)
+      return False
+
+    # `clean' may have removed the file between our open and flock, leaving
+    # us holding a lock nobody else can see
+    try: current = os.stat(lockpath)
+    except OSError, ex: current = None
+    if None is current \
+      or not os.path.samestat(current, os.fstat(lockfile.fileno())):
+      lockfile.close()
+      return False
+
+    # a shared holder knows any recorded owner is gone, so clears it too
+    lockfile.truncate(0)
+    if not self.shared:
+      lockfile.write('%d %s %s %f\n' % (
+        os.getpid(), socket.gethostname(),
+        _get_start_time(os.getpid()) or '-', time.time()
+      ))
+      lockfile.flush()
+    self.lockfile = lockfile
+    return True
+
+  def _take_over(self, owner):
+    # takeovers are serialized on the node's directory, and the owner is
+    # checked again under it, so only one acquirer removes the stale file
+    # and nobody removes the file that replaced it
+    dirfd = os.open(self.path, os.O_RDONLY)
+    try:
+      fcntl.flock(dirfd, fcntl.LOCK_EX)
+      if owner == _RepoLock.get_owner(self.path):
+        os.remove(self._get_lockpath())
+        if not None is self.logger:
+          self.logger.warning(
+            'took over lock on [%s] from dead process [%d] on [%s]'
+              % (self.path, owner[0], owner[1])
+          )
+    finally:
+      os.close(dirfd)
+
+  def _take_ticket(self):
+    ticket = os.path.join(
+      self.path,
+      '%s%017.6f.%s.%d' % (
+        _RepoLock.TicketPrefix, time.time(), socket.gethostname(), os.getpid()
+      )
+    )
+    open(ticket, 'w').close()
+    return ticket
+
+  def _is_next(self, ticket):
+    for name in sorted(os.listdir(self.path)):
+      if not name.startswith(_RepoLock.TicketPrefix): continue
+      if name == os.path.basename(ticket): return True
+      # skip (and clear) tickets left behind by waiters that died
+      if not _RepoLock.remove_stale_ticket(self.path, name): return False
+    return True
+
+  @staticmethod
+  def remove_stale_ticket(path, name):
+    '''
+      Removes the fifo ticket name from the node at path if the waiter that
+      left it has died. Tickets from other hosts are taken to be live.
+      Returns whether it did.
+    '''
+    # <time>.<host>.<pid>, though older tickets have no host
+    owner = name[len(_RepoLock.TicketPrefix):].split('.', 2)[-1].rsplit('.', 1)
+    host = owner[0] if 2 == len(owner) else None
+    if _is_running(int(owner[-1]), host): return False
+    try: os.remove(os.path.join(path, name))
+    except OSError: pass
+    return True
 
   def _get_lockpath(self):
     return os.path.join(self.path, _RepoLock.RepoLockFileName)
@@ -193,7 +683,127 @@ class _RepoLock(object):
   def _throw_busy(self):
     raise _RepoLock.LockError()
 
+class _RepoTransaction(object):
+  '''
+    Groups repository changes so they are applied together. Each node is
+    locked once, on first use, and stays locked until the transaction ends.
+    Metafile writes and index updates are deferred to commit, so a parent
+    touched by several operations is written once. Filesystem changes that
+    can't be deferred register an undo action. If the transaction fails,
+    those actions run in reverse order. A transaction entered while another
+    is open on the same repository joins it.
+  '''
+
+  BackupSuffix = '.evolvebak'
+
+  def __init__(self, repo):
+    self.repo = repo
+    self.joined = False
+
+  def __enter__(self):
+    if not None is self.repo._txn:
+      self.joined = True
+      return self.repo._txn
+    self.locks = []
+    self.metafiles = { }
+    self.backups = { }
+    self.undo = []
+    self.oncommit = []
+    self.messages = []
+    self.repo._txn = self
+    return self
+
+  def __exit__(self, type, value, traceback):
+    if self.joined: return
+    self.repo._txn = None
+    try:
+      if None is type:
+        try: self._commit()
+        except BaseException, ex:
+          self._rollback()
+          raise
+        for action in self.oncommit: action()
+      else:
+        self._rollback()
+    finally:
+      self._release()
+
+  def lock(self, path, shared=False):
+    if not path in [p for p, lock in self.locks]:
+      # readers don't need to hold their lock for the rest of the transaction
+      if shared: return _RepoLock(path, True, logger=self.repo.logger)
+      lock = _RepoLock(path, logger=self.repo.logger)
+      lock.__enter__()
+      self.locks.append((path, lock))
+    return _HeldLock()
+
+  def save(self, path, metafile):
+    self.metafiles[path] = metafile
+
+  def backup(self, path):
+    '''
+      Hardlinks a copy of the directory at path aside, restoring it on
+      rollback. Only safe for directories whose files are replaced rather
+      than modified in place, like release bin/ folders.
+    '''
+    if path in self.backups: return
+    backuppath = os.path.join(
+      os.path.dirname(path),
+      '.' + os.path.basename(path) + _RepoTransaction.BackupSuffix
+    )
+    if os.path.exists(backuppath): do_or_die('rm -rf ' + backuppath)
+    do_or_die('cp -al %s %s' % (path, backuppath))
+    self.backups[path] = backuppath
+    self.undo.append(
+      lambda: do_or_die('rm -rf %s && mv %s %s' % (path, backuppath, path))
+    )
+    self.oncommit.append(lambda: do_or_die('rm -rf ' + backuppath))
+
+  def _commit(self):
+    # children are written before their parents, so a parent never lists a
+    # child whose metafile doesn't exist yet
+    entries = sorted(
+      self.metafiles.iteritems(), key=lambda entry: -entry[0].count('/')
+    )
+    self.repo._mark_pending()
+    for path, metafile in entries:
+      self._keep(_RepoMetaFile._get_metapath(path))
+      metafile.save(path)
+    self.repo._update_index(*entries)
+    if self.messages:
+      self.repo.logger.info(
+        'committed transaction: %s' % '; '.join(self.messages)
+      )
+
+  def _keep(self, metapath):
+    if not os.path.exists(metapath): return
+    with open(metapath, 'r') as metafile: contents = metafile.read()
+    def restore():
+      with open(metapath, 'w') as metafile: metafile.write(contents)
+    self.undo.append(restore)
+
+  def _rollback(self):
+    for action in reversed(self.undo):
+      try: action()
+      except BaseException, ex:
+        self.repo.logger.error('failed to undo transaction step: %s' % ex)
+    self.repo.logger.warning(
+      'rolled back transaction of [%d] operations' % len(self.messages)
+    )
+
+  def _release(self):
+    for path, lock in reversed(self.locks): lock.__exit__(None, None, None)
+
+class _HeldLock(object):
+  def __enter__(self): pass
+  def __exit__(self, type, value, traceback): pass
+
 class Repository(object):
+  IndexBuildJobs = 8
+  IndexLockWait = 300
+  PendingPrefix = 'pending.'
+  PushRetries = 3
+  IncomingDirName = os.path.join('.evolve', 'incoming')
 
   @staticmethod
   def init_repo(path):
@@ -230,6 +840,11 @@ class Repository(object):
     self.path = path.strip().rstrip('/')
     self._validate_repo()
     self.logger = get_logger(path + '/.logs/repo.log', logging.INFO)
+    self.store = ObjectStore(self.path)
+    self._index = None
+    self._graph = None
+    self._txn = None
+    self._pending = threading.local()
 
   def _validate_repo(self):
     valid = True
@@ -245,149 +860,655 @@ class Repository(object):
       raise ArgumentError(
         'path [%s] does not correspond to a repository root' % self.path
       )
+
+  def _get_index(self):
+    if None is self._index:
+      index = RepoIndex(self.path)
+      if not index.is_built() or self._get_interrupted():
+        self._rebuild_index(index, Repository.IndexBuildJobs, False)
+      self._index = index
+    return self._index
+
+  def _rebuild_index(self, index, jobs, force):
+    # writers update the index under a shared lock on its directory, so none
+    # of their updates can land between the scan and the rebuild
+    with _RepoLock(
+      os.path.dirname(index.path), timeout=Repository.IndexLockWait,
+      logger=self.logger
+    ):
+      interrupted = self._get_interrupted()
+      # someone else may have rebuilt it while we waited
+      if not force and index.is_built() and not interrupted: return
+      with span('index.rebuild'):
+        index.rebuild(self._scan('', jobs))
+      for marker in interrupted:
+        try: os.remove(marker)
+        except OSError, ex:
+          if errno.ENOENT != ex.errno: raise
+    if interrupted:
+      self.logger.warning(
+        'rebuilt repository index after [%d] interrupted updates'
+          % len(interrupted)
+      )
+    else:
+      self.logger.info('built repository index')
+
+  def _update_index(self, *entries):
+    if not None is self._txn: return # indexed when the transaction commits
+    index = self._get_index()
+    with span('index.update'), _RepoLock(
+      os.path.dirname(index.path), True, timeout=Repository.IndexLockWait,
+      logger=self.logger
+    ):
+      index.update(
+        *[(self._get_relpath(fullpath), meta) for fullpath, meta in entries]
+      )
+    self._clear_pending()
+
+  def _mark_pending(self):
+    # left in the index directory from a thread's first metafile save until
+    # the index has caught up with it, so that an update cut short by a
+    # crash is found (and the index rebuilt) by the next process to open it
+    if not None is getattr(self._pending, 'path', None): return
+    path = os.path.join(
+      os.path.dirname(self._get_index().path), '%s%s.%d.%d' % (
+        Repository.PendingPrefix, socket.gethostname(), os.getpid(),
+        threading.current_thread().ident
+      )
+    )
+    open(path, 'a').close()
+    self._pending.path = path
+
+  def _clear_pending(self):
+    path = getattr(self._pending, 'path', None)
+    if None is path: return
+    os.remove(path)
+    self._pending.path = None
+
+  def _get_interrupted(self):
+    # markers left by processes that are gone; those of other hosts can't be
+    # told apart from live ones, so are left to the hosts that made them
+    indexdir = os.path.join(self.path, RepoIndex.IndexDirName)
+    result = []
+    for name in os.listdir(indexdir):
+      if not name.startswith(Repository.PendingPrefix): continue
+      host, pid, thread = \
+        name[len(Repository.PendingPrefix):].rsplit('.', 2)
+      if not _is_running(int(pid), host):
+        result.append(os.path.join(indexdir, name))
+    return result
+
+  def transaction(self):
+    '''
+      Returns a context under which create, install, deploy and update calls
+      are applied as a unit: all of them take effect, or none do.
+    '''
+    return _RepoTransaction(self)
+
+  def _lock(self, path, shared=False):
+    if None is self._txn: return _RepoLock(path, shared, logger=self.logger)
+    return self._txn.lock(path, shared)
+
+  def _load(self, fullpath):
+    if not None is self._txn and fullpath in self._txn.metafiles:
+      return self._txn.metafiles[fullpath]
+    return _RepoMetaFile.load(fullpath)
+
+  def _save(self, fullpath, metafile):
+    if None is self._txn:
+      self._mark_pending()
+      metafile.save(fullpath)
+    else:
+      self._txn.save(fullpath, metafile)
+
+  def _on_rollback(self, action):
+    if not None is self._txn: self._txn.undo.append(action)
+
+  def _on_commit(self, action):
+    if None is self._txn: action()
+    else: self._txn.oncommit.append(action)
+
+  def _log(self, message):
+    if None is self._txn: self.logger.info(message)
+    else: self._txn.messages.append(message)
+
+  def _get_relpath(self, fullpath):
+    return fullpath[len(self.path):].strip('/')
+
+  def _get_header(self, fullpath):
+    if not None is self._txn and fullpath in self._txn.metafiles:
+      return self._txn.metafiles[fullpath]
+    row = self._get_index().get(self._get_relpath(fullpath))
+    if None is row: return _RepoMetaFile.load(fullpath)
+    return _RepoMetaFile.from_index(row)
+
+  def _scan(self, path, jobs=1):
+    '''
+      Yields (path, metafile) for the location at path and everything beneath
+      it, depth first in name order, reading each metafile from disk. With
+      more than one job, the metafiles are read ahead of the caller by a pool
+      of that many threads, which hides the latency of each read on network
+      filesystems.
+    '''
+    return iwalk_parallel(self._scan_node, path, jobs)
+
+  def _scan_node(self, path):
+    metafile = _RepoMetaFile.load(os.path.join(self.path, path))
+    # get_children reads the body, so that happens in the pool too
+    children = sorted(metafile.get_children())
+    return metafile, [os.path.join(path, child) for child in children]
+
+  def reindex(self, jobs=1):
+    '''
+      Rebuilds the repository index from the metafiles on disk, read by
+      `jobs' threads.
+    '''
+    if None is self._index: self._index = RepoIndex(self.path)
+    self._rebuild_index(self._index, jobs, True)
+
+  def migrate(self, jobs=1):
+    '''
+      Rewrites every metafile in the repository that predates the current
+      metafile format, reading them with `jobs' threads. Returns the number
+      of metafiles converted.
+    '''
+    converted = 0
+    for path, metafile in self._scan('', jobs):
+      fullpath = os.path.join(self.path, path)
+      if _RepoMetaFile.Version > metafile._version:
+        with _RepoLock(fullpath):
+          metafile.write(fullpath)
+        converted += 1
+    self.logger.info('migrated [%d] metafiles' % converted)
+    return converted
       
   def create_project(self, path):
     path = path.strip().strip('/')
-    parent, metafile = self._get_valid_project_parent_path(path)
     fullpath = os.path.join(self.path, path)
-    projects = fullpath.replace(parent + '/', '').split('/')
-    
-    try:
-      with _RepoLock(parent):
-        self._create_project(parent, projects)
-        metafile.projects.append(projects[0])
-        metafile.save(parent)
-    except _RepoLock.LockError, ex:
-      raise RepoError('parent at [%s] is locked' % parent)
-    except BaseException, ex:
-      firstproject = os.path.join(parent, projects[0])
-      if os.path.exists(firstproject):
-        do_or_die('rm -rf ' + firstproject)
-      raise
+    parent = None
 
-    self.logger.info('created project [%s]' % path)
+    while None is parent:
+      parent, metafile = self._get_valid_project_parent_path(path)
+      projects = fullpath.replace(parent + '/', '').split('/')
+      firstproject = os.path.join(parent, projects[0])
+      validated = False
+      try:
+        with self._lock(parent):
+          # validated again now that we hold the lock - if someone else
+          # created part of the path while we waited, start over beneath it
+          if parent != self._get_valid_project_parent_path(path)[0]:
+            parent = None
+            continue
+          metafile = self._load(parent)
+          validated = True
+          created = []
+          self._create_project(parent, projects, created)
+          metafile.projects.append(projects[0])
+          self._save(parent, metafile)
+          self._update_index((parent, metafile), *created)
+      except _RepoLock.LockError, ex:
+        raise RepoError('parent at [%s] is locked' % parent)
+      except BaseException, ex:
+        if validated and os.path.exists(firstproject):
+          do_or_die('rm -rf ' + firstproject)
+        raise
+
+    self._on_rollback(lambda: do_or_die('rm -rf ' + firstproject))
+    self._log('created project [%s]' % path)
 
   def create_release(self, path):
     path = path.strip().strip('/')
     project, metafile, release = self._get_valid_project_and_release(path)
 
+    fullpath = os.path.join(project, release)
+    validated = False
     try:
-      with _RepoLock(project):
-        self._create_release(project, release)
+      with self._lock(project):
+        # the project may have changed while we waited for the lock
+        project, metafile, release = self._get_valid_project_and_release(path)
+        validated = True
+        releasemeta = self._create_release(project, release)
         metafile.releases.append(release)
-        metafile.save(project)
+        self._save(project, metafile)
+        self._update_index((project, metafile), (fullpath, releasemeta))
     except _RepoLock.LockError, ex:
       raise RepoError('project at [%s] is locked' % project)
     except BaseException, ex:
-      fullpath = os.path.join(project, release)
-      if os.path.exists(fullpath):
+      if validated and os.path.exists(fullpath):
         do_or_die('rm -rf ' + fullpath)
       raise
 
-    self.logger.info('created release [%s]' % path)
+    self._on_rollback(lambda: do_or_die('rm -rf ' + fullpath))
+    self._log('created release [%s]' % path)
 
   def create_rlink(self, path, name):
     path, name = path.strip().strip('/'), name.strip().strip('/')
     project, metafile = self._get_valid_project_for_rlink(path, name)
 
+    fullpath = os.path.join(project, name)
+    validated = False
     try:
-      with _RepoLock(project):
-        self._create_rlink(project, path, name)
+      with self._lock(project):
+        # the project may have changed while we waited for the lock
+        project, metafile = self._get_valid_project_for_rlink(path, name)
+        validated = True
+        rlinkmeta = self._create_rlink(project, path, name)
         metafile.releases.append(name)
-        metafile.save(project)
+        self._save(project, metafile)
+        self._update_index((project, metafile), (fullpath, rlinkmeta))
     except _RepoLock.LockError, ex:
       raise RepoError('project at [%s] is locked' % project)
     except BaseException, ex:
-      fullpath = os.path.join(project, name)
-      if os.path.exists(fullpath):
+      if validated and os.path.exists(fullpath):
         do_or_die('rm -rf ' + fullpath)
       raise
 
-    self.logger.info(
+    self._on_rollback(lambda: do_or_die('rm -rf ' + fullpath))
+    self._log(
       'created rlink [%s]' % os.path.join(path.split('/')[-1], name)
     )
 
-  def update_rlink(self, path, name):
+  def update_rlink(self, path, name, touch=False, rollback=False):
+    '''
+      Retargets an rlink at the release at path, swapping its bin symlink
+      atomically. If touch is set, the files in the new release that differ
+      from those in the old one get their mtime updated. rollback records
+      the change as a rollback in the rlink's history.
+    '''
     path = path.strip().strip('/')
     rlinkpath, rlinkmetafile = self._get_valid_rlink_for_update(path, name)
-    with _RepoLock(rlinkpath): # should not fail at this point
-      if rlinkmetafile.target == path:
-        raise ArgumentError('existing and specified targets are the same')
-
-      releasepath = os.path.join(self.path, path)
-      rlinkbin = os.path.join(rlinkpath,'bin')
+    try:
+      with self._lock(rlinkpath):
+        # the rlink may have been updated while we waited for the lock
+        rlinkpath, rlinkmetafile = self._get_valid_rlink_for_update(path, name)
+        if rlinkmetafile.target == path:
+          raise ArgumentError('existing and specified targets are the same')
+
+        oldbin = os.path.join(self.path, rlinkmetafile.target, 'bin')
+        newbin = os.path.join(self.path, path, 'bin')
+        linkpath = os.path.join(rlinkpath, 'bin')
+        replace_symlink(newbin, linkpath)
+        self._on_rollback(lambda: replace_symlink(oldbin, linkpath))
+        if touch:
+          self._log(
+            'touched [%d] changed files in [%s]'
+              % (touch_changed(oldbin, newbin), path)
+          )
+
+        entries = rlinkmetafile.update(path, rollback)
+        self._save(rlinkpath, rlinkmetafile)
+        self._update_index((rlinkpath, rlinkmetafile))
+        # appended once the new target is in place, still under the lock
+        history = _RlinkHistory(rlinkpath)
+        self._on_commit(lambda: history.append(*entries))
+    except _RepoLock.LockError, ex:
+      raise RepoError('rlink at [%s] is locked' % rlinkpath)
+
+  def rollback_rlink(self, path, steps=1, to=None, touch=False):
+    '''
+      Points the rlink at path back at one of its previous targets: the
+      `steps'th distinct release before the current one, or the release `to'
+      (a path, or a name in the rlink's project) if the rlink has had it
+      before. Releases a rollback left aren't counted, so rolling back twice
+      goes two releases back rather than returning to the first. The history
+      is read under the rlink's lock, and the swap is the same as
+      update_rlink. Returns the targets before and after.
+    '''
+    path = path.strip().strip('/')
+    fullpath = os.path.join(self.path, path)
+    if not os.path.exists(fullpath):
+      raise ArgumentError('rlink path not found: [%s]' % path)
+    if None is to and 1 > steps:
+      raise ArgumentError('cannot roll back [%d] steps' % steps)
+    if not None is to:
+      to = to.strip().strip('/')
+      if -1 == to.find('/'): to = os.path.join(os.path.dirname(path), to)
+
+    # a transaction holds the lock for update_rlink, which takes it again
+    with self.transaction():
+      try:
+        with self._lock(fullpath):
+          history = self.get_history(path)
+          current = self._load(fullpath).target
+          if not None is to:
+            if not to in [entry[0] for entry in history]:
+              raise ArgumentError(
+                '[%s] is not a previous target of rlink [%s]' % (to, path)
+              )
+            if to == current:
+              raise ArgumentError(
+                'rlink [%s] already points at [%s]' % (path, to)
+              )
+            target = to
+          else:
+            targets = Repository._get_rollback_targets(history, current)
+            if len(targets) < steps:
+              raise ArgumentError(
+                'rlink [%s] has only [%d] earlier targets'
+                  % (path, len(targets))
+              )
+            target = targets[steps - 1]
+          self.update_rlink(target, os.path.basename(path), touch, True)
+      except _RepoLock.LockError, ex:
+        raise RepoError('rlink at [%s] is locked' % path)
+
+    self._log(
+      'rolled back rlink [%s] from [%s] to [%s]' % (path, current, target)
+    )
+    return current, target
 
-      do_or_die(
-        'rm %s && ln -s %s %s'
-          % (rlinkbin, os.path.join(releasepath,'bin'), rlinkbin)
+  @staticmethod
+  def _get_rollback_targets(history, current):
+    # replays the history, oldest first, as a stack of releases: an update
+    # pushes the target it replaced, while a rollback drops the target it
+    # left, and everything above the one it went back to (a rollback --to a
+    # release no longer on the stack counts as an update). Returns what's
+    # left, newest first, without repeats or the current target
+    entries = list(reversed(history))
+    stack = []
+    for entry, reached in zip(
+      entries, [e[0] for e in entries[1:]] + [current]
+    ):
+      if 3 < len(entry) and _RlinkHistory.RolledBack == entry[3] \
+        and reached in stack:
+        del stack[len(stack) - 1 - stack[::-1].index(reached):]
+      else:
+        stack.append(entry[0])
+
+    targets = []
+    for target in reversed(stack):
+      if target != current and not target in targets: targets.append(target)
+    return targets
+
+  def rollback_all(self, path, steps=1, to=None, touch=False, jobs=1):
+    '''
+      Rolls back every rlink at or beneath path as rollback_rlink does, up to
+      `jobs' at once; `to' can only be a release name. Returns a (path,
+      before, after, seconds, error) tuple for each rlink, in name order.
+    '''
+    if not None is to and -1 != to.strip().strip('/').find('/'):
+      raise ArgumentError(
+        'rlinks in different projects can only be rolled back to a release name'
       )
-      # TODO: this should be an option at the command line
-      do_or_die('find %s/ | egrep -v \'^%s/$\' | xargs touch' % (rlinkbin, rlinkbin))
-
-      rlinkmetafile.update(path)
-      rlinkmetafile.save(rlinkpath)
+    rlinks = [p for p, d, l, m in self.iterwalk(path, types=['rlink'])]
+    if 0 == len(rlinks):
+      raise ArgumentError('no rlinks found at [%s]' % path.strip().strip('/'))
+
+    def _rollback(repo, rlink):
+      start = time.time()
+      try: before, after = repo.rollback_rlink(rlink, steps, to, touch)
+      except RepoError, ex:
+        return rlink, None, None, time.time() - start, ex
+      return rlink, before, after, time.time() - start, None
+    return list(self._imap_parallel(_rollback, rlinks, jobs))
 
   def get_directory_contents(self, path):
     path = path.strip().strip('/')
-    fullpath = os.path.join(self.path, path)
-
-    if not os.path.exists(fullpath):
-      raise ArgumentError('repository location not found: [%s]' % path)
+    index = self._get_index()
+    row = index.get(path)
 
-    if not _RepoMetaFile.exists(fullpath):
+    if None is row:
+      if not os.path.exists(os.path.join(self.path, path)):
+        raise ArgumentError('repository location not found: [%s]' % path)
       raise ArgumentError(
           'location does not correspond to repository element: [%s]' % path
       )
     
-    targetmeta = _RepoMetaFile.load(fullpath)
-    childdescriptors = { }
-
-    for child in targetmeta.get_children():
-      childmeta = _RepoMetaFile.load(os.path.join(fullpath, child))
-      childdescriptors[child] = childmeta.get_descriptor()
+    targetmeta = _RepoMetaFile.from_index(row)
+    childdescriptors = dict(
+      (child['name'], _RepoMetaFile.from_index(child).get_descriptor())
+        for child in index.get_children(path)
+    )
 
     return (targetmeta.get_descriptor(), childdescriptors)
 
   def walk(self, path, callback):
-    def _walk(self, path, callback, more):
-      fullpath = os.path.join(self.path, path)
-      metafile = _RepoMetaFile.load(fullpath)
+    more = [] # shared between calls, so only valid during the callback
+    for path, depth, last, metafile in self.iterwalk(path):
+      del more[depth:]
+      more.append(not last)
       callback(path, more, metafile.get_type())
-      
-      if not metafile.is_leaf():
-        sortedmeta = sorted(
-          [d for d in os.listdir(fullpath) if not d.startswith('.')]
-        )
-        for i in range(len(sortedmeta)-1):
-          _walk(self, os.path.join(path, sortedmeta[i]), callback, more+[True])
-        else:
-          if 0 < len(sortedmeta):
-            _walk(self,os.path.join(path, sortedmeta[-1]),callback,more+[False])
 
+  def iterwalk(
+    self, path, max_depth=None, types=None, deployed=None, pattern=None
+  ):
+    '''
+      Returns a generator of (path, depth, last, metafile) for the location
+      at path and everything beneath it, depth first and in name order. last
+      is set for the last of its siblings, and metafile only holds the
+      fields kept in the index. Children are read from the index one level
+      at a time as the walk reaches them, and not at all below max_depth.
+
+      types (a list of metafile types), deployed and pattern (a glob for the
+      name) filter what's yielded without changing what's walked. With
+      deployed set, only releases whose deployed flag matches are yielded.
+    '''
     path = path.strip().strip('/')
-    if not os.path.exists(os.path.join(self.path, path)):
-      raise ArgumentError('repository location not found: [%s]' % path)
-
-    _walk(self, path, callback, [False])
-
-  def get_history(self, path):
+    row = self._get_index().get(path)
+    if None is row:
+      if not os.path.exists(os.path.join(self.path, path)):
+        raise ArgumentError('repository location not found: [%s]' % path)
+      raise ArgumentError(
+          'location does not correspond to repository element: [%s]' % path
+      )
+    return self._iterwalk(row, max_depth, types, deployed, pattern)
+
+  def _iterwalk(self, row, max_depth, types, deployed, pattern):
+    index = self._get_index()
+    levels = [iter([(row, True)])]
+    while levels:
+      try: row, last = levels[-1].next()
+      except StopIteration:
+        levels.pop()
+        continue
+
+      depth = len(levels) - 1
+      metafile = _RepoMetaFile.from_index(row)
+      if (None is types or row['type'] in types) \
+        and (None is deployed or (
+          _RepoRelease.Type == row['type'] and deployed == metafile.deployed
+        )) \
+        and (None is pattern or fnmatch.fnmatch(row['name'], pattern)):
+        yield row['path'], depth, last, metafile
+
+      if not metafile.is_leaf() and (None is max_depth or depth < max_depth):
+        levels.append(_mark_last(index.get_children(row['path'])))
+
+  def get_history(self, path, limit=None, since=None):
+    '''
+      Returns the rlink's previous targets as (target, user, time) entries,
+      newest first: at most limit of them, and none from before since.
+    '''
     path = path.strip().strip('/')
 
     fullpath = os.path.join(self.path, path)
     if not os.path.exists(fullpath):
       raise ArgumentError('rlink path not found: [%s]' % path)
 
-    metafile = _RepoMetaFile.load(fullpath)
-    if not _RepoRlink.Type == metafile.get_type():
-      raise ArgumentError('path does not correspond to an rlink: [%s]' % path)
+    try:
+      # shared, so the lazily read body matches the header
+      with self._lock(fullpath, True):
+        metafile = self._load(fullpath)
+        if not _RepoRlink.Type == metafile.get_type():
+          raise ArgumentError(
+            'path does not correspond to an rlink: [%s]' % path
+          )
+        history = _RlinkHistory(fullpath).read(limit, since)
+        if not metafile.history: return history
+        # older versions of evolve may still have added entries to the
+        # metafile, before or after the log's
+        history = sorted(
+          history + [
+            tuple(entry) for entry in metafile.history
+              if None is since or entry[2] >= since
+          ],
+          key=lambda entry: -entry[2]
+        )
+        return history if None is limit else history[:limit]
+    except _RepoLock.LockError, ex:
+      raise RepoError('rlink at [%s] is locked' % path)
+
+  def compact_history(self, path, keep, recursive=False):
+    '''
+      Drops all but the newest keep entries from the history of the rlink at
+      path, or with recursive, of every rlink at or beneath path. Returns
+      the number of entries dropped.
+    '''
+    path = path.strip().strip('/')
+    if recursive:
+      rlinks = [p for p, d, l, m in self.iterwalk(path, types=['rlink'])]
+    else:
+      fullpath = os.path.join(self.path, path)
+      if not os.path.exists(fullpath) \
+        or _RepoRlink.Type != self._get_header(fullpath).get_type():
+        raise ArgumentError(
+          'path does not correspond to an rlink: [%s]' % path
+        )
+      rlinks = [path]
 
-    return metafile.get_history()
+    dropped = 0
+    for rlink in rlinks:
+      fullpath = os.path.join(self.path, rlink)
+      try:
+        with self._lock(fullpath):
+          metafile = self._load(fullpath)
+          history = _RlinkHistory(fullpath)
+          if metafile.history:
+            history.append(*reversed(metafile.history))
+            metafile.history = []
+            self._save(fullpath, metafile)
+            self._update_index((fullpath, metafile))
+          dropped += history.compact(keep)
+      except _RepoLock.LockError, ex:
+        raise RepoError('rlink at [%s] is locked' % rlink)
+    self._log('dropped [%d] history entries under [%s]' % (dropped, path))
+    return dropped
+
+  def get_dependency_graph(self):
+    '''
+      Returns the DependencyGraph of the repository. It is built from the
+      index, and only rebuilt once the dependencies recorded there change.
+      Inside a transaction, the dependencies it has changed are applied on
+      top.
+    '''
+    index = self._get_index()
+    generation = index.get_generation()
+    if None is self._graph or generation != self._graph[0]:
+      self._graph = (generation, DependencyGraph(index.get_edges()))
+    graph = self._graph[1]
+
+    if None is self._txn: return graph
+    pending = [
+      (self._get_relpath(fullpath), metafile)
+        for fullpath, metafile in self._txn.metafiles.iteritems()
+          if metafile.get_type() in (_RepoRelease.Type, _RepoRlink.Type)
+    ]
+    if not pending: return graph
+    graph = DependencyGraph(index.get_edges())
+    for path, metafile in pending:
+      graph.replace(path, metafile.dependencies + (
+        [metafile.target] if _RepoRlink.Type == metafile.get_type() else []
+      ))
+    return graph
+
+  def get_dependencies(self, path, transitive=False):
+    '''
+      Returns the releases and rlinks that the release or rlink at path
+      depends on, directly or transitively. Transitive dependencies come
+      ahead of what depends on them.
+    '''
+    path = path.strip().strip('/')
+    self._get_valid_dependency(path)
+    return self.get_dependency_graph().get_dependencies(path, transitive)
+
+  def get_dependents(self, path, transitive=False):
+    '''
+      Returns the releases and rlinks that depend on the release or rlink at
+      path, directly or transitively.
+    '''
+    path = path.strip().strip('/')
+    self._get_valid_dependency(path)
+    return self.get_dependency_graph().get_dependents(path, transitive)
 
-  def install(self, path, artifactpath):
+  def add_dependencies(self, path, *dependencies):
+    '''
+      Declares that the release or rlink at path depends on each of the
+      releases and rlinks in dependencies. Deployed releases can't gain
+      dependencies, and none may be added that would make a cycle.
+    '''
+    self._change_dependencies(path, dependencies, True)
+
+  def remove_dependencies(self, path, *dependencies):
+    self._change_dependencies(path, dependencies, False)
+
+  def _change_dependencies(self, path, dependencies, add):
+    path = path.strip().strip('/')
+    dependencies = [d.strip().strip('/') for d in dependencies]
+    fullpath, metafile = \
+      self._get_valid_node_for_dependencies(path, dependencies, add)
+
+    try:
+      with self._lock(fullpath):
+        # the node may have changed while we waited for the lock
+        fullpath, metafile = \
+          self._get_valid_node_for_dependencies(path, dependencies, add)
+        if add:
+          metafile.dependencies = \
+            sorted(set(metafile.dependencies) | set(dependencies))
+        else:
+          metafile.dependencies = [
+            d for d in metafile.dependencies if not d in dependencies
+          ]
+        self._save(fullpath, metafile)
+        self._update_index((fullpath, metafile))
+    except _RepoLock.LockError, ex:
+      raise RepoError('%s at [%s] is locked' % (metafile.get_type(), path))
+
+    self._log(
+      '%s dependencies of [%s]: [%s]'
+        % ('added' if add else 'removed', path, ', '.join(dependencies))
+    )
+
+  def install(
+    self, path, artifactpath, checksum=False, rsync=False, jobs=1,
+    progress=None
+  ):
+    '''
+      Makes the release's bin/ folder a copy of the artifact path (relative to
+      its src/ folder). By default this only copies changed files - compared
+      by size and mtime, or by content if checksum is set - hardlinking them
+      from the object store if the repository has one, and returns a
+      SyncStats. Files are synced by `jobs' threads, and progress is called
+      with the SyncStats as they complete. rsync selects the external rsync
+      instead, returning None.
+    '''
     path = path.strip().strip('/')
     artifactpath = artifactpath.strip().strip('/')
     target, src = self._get_valid_paths_for_install(path, artifactpath)
-    do_or_die('rsync -r --delete --force %s/ %s' % (src, target))
+
+    try:
+      with self._lock(os.path.join(self.path, path)):
+        # the release may have been deployed while we waited for the lock
+        target, src = self._get_valid_paths_for_install(path, artifactpath)
+        if not None is self._txn: self._txn.backup(target)
+        if rsync:
+          do_or_die(
+            'rsync -r --delete --force %s%s/ %s'
+              % ('--checksum ' if checksum else '', src, target)
+          )
+          return None
+
+        stats = sync_tree(
+          src, target, checksum, self.store if self.store.exists() else None,
+          jobs, progress
+        )
+    except _RepoLock.LockError, ex:
+      raise RepoError('release at [%s] is locked' % path)
+
+    self._log(
+      'installed [%s] into [%s]: %s' % (artifactpath, path, stats)
+    )
+    return stats
 
   def deploy(self, path):
     path = path.strip().strip('/')
@@ -395,19 +1516,550 @@ class Repository(object):
       self._get_valid_release_and_src_for_deploy(path)
 
     try:
-      with _RepoLock(releasepath):
+      with self._lock(releasepath):
+        # the release may have changed while we waited for the lock
+        releasepath, releasemeta, src = \
+          self._get_valid_release_and_src_for_deploy(path)
         releasemeta.deployed = True
-        releasemeta.save(releasepath)
+        self._save(releasepath, releasemeta)
+        self._update_index((releasepath, releasemeta))
+        mode = stat.S_IMODE(os.stat(src).st_mode)
         os.chmod(src, 0755)
+        self._on_rollback(lambda: os.chmod(src, mode))
+        if self.store.exists():
+          bin = os.path.join(releasepath, 'bin')
+          self._on_commit(lambda: self.store.freeze(bin))
     except _RepoLock.LockError, ex:
       raise RepoError('release at [%s] is locked' % path)
 
-  def clean(self, path):
+  def deploy_all(self, path, jobs=1):
+    '''
+      Deploys the release at path (or an rlink's target) and every release
+      it depends on, transitively, that isn't deployed yet. They go in
+      waves, each release after those it depends on, and the releases in a
+      wave are deployed by up to `jobs' threads at once. Returns a (path,
+      wave, seconds, error) tuple per release attempted, and the releases
+      that weren't: a wave with a failure is the last one attempted.
+    '''
+    path = path.strip().strip('/')
+    self._get_valid_dependency(path)
+
+    graph = self.get_dependency_graph()
+    releases = set()
+    for node in graph.get_order([path]):
+      metafile = self._get_header(os.path.join(self.path, node))
+      if _RepoRelease.Type == metafile.get_type() and not metafile.deployed:
+        releases.add(node)
+    if 0 == len(releases):
+      raise ArgumentError(
+        '[%s] and its dependencies are already deployed' % path
+      )
+
+    def _deploy(repo, release):
+      start = time.time()
+      try: repo.deploy(release)
+      except RepoError, ex: return release, time.time() - start, ex
+      return release, time.time() - start, None
+
+    results = []
+    waves = graph.get_waves([path], releases)
+    for wave, members in enumerate(waves):
+      failed = False
+      for release, seconds, error in \
+        self._imap_parallel(_deploy, members, jobs):
+        results.append((release, wave + 1, seconds, error))
+        failed = failed or not None is error
+      if failed: return results, sum(waves[wave + 1:], [])
+    return results, []
+
+  def push(self, path, targetpath, checksum=False, jobs=1, progress=None):
+    '''
+      Copies the deployed release at path, or the rlink at path, to the
+      repository at targetpath along with everything it depends on, in a
+      single transaction on the target. Releases are created there, their
+      bin/ folders synced (see install) into the target's object store and
+      deployed; those the target has deployed already are left alone.
+      Rlinks are created where they are missing, and the one at path is
+      retargeted. Returns a (path, action, stats) tuple for each, in
+      dependency order, where stats is the SyncStats of a release pushed.
+    '''
+    path = path.strip().strip('/')
+    nodes = self._get_push_nodes(path)
+    target = Repository(targetpath)
+    if os.path.realpath(target.path) == os.path.realpath(self.path):
+      raise ArgumentError('cannot push a repository to itself')
+
+    results = []
+    with target.transaction():
+      for node, metafile in nodes:
+        if _RepoRelease.Type == metafile.get_type():
+          results.append(target._receive_release(
+            node, metafile.dependencies, self._get_srcbin(node)[1], checksum,
+            jobs, progress
+          ))
+        else:
+          results.append(target._receive_rlink(
+            node, metafile.target, metafile.dependencies, node == path
+          ))
+
+    self._log('pushed [%s] to [%s]' % (path, target.path))
+    return results
+
+  def push_stream(self, path, command, progress=None):
+    '''
+      Like push, but to the `evolve receive' at the other end of a shell
+      command's stdin and stdout - over ssh, say. The target is sent a
+      manifest of what is being pushed, and asks for the content its object
+      store lacks, which is sent in checksummed, compressed chunks. If the
+      stream breaks, the command is run again, up to PushRetries times, and
+      the target resumes each partly received file where it left off.
+      progress is called with the bytes sent and the bytes to send. Returns
+      push's results, with stats as reported by the target, and the number
+      of bytes sent.
+    '''
+    path = path.strip().strip('/')
+    files = { }
+    nodes = []
+    for node, metafile in self._get_push_nodes(path):
+      entry = {
+        'path': node, 'type': metafile.get_type(),
+        'dependencies': metafile.dependencies,
+      }
+      if _RepoRelease.Type == metafile.get_type():
+        entry['files'] = self._get_manifest(node, files)
+      else:
+        entry['target'] = metafile.target
+      nodes.append(entry)
+    manifest = {'path': path, 'nodes': nodes}
+
+    sent = 0
+    for attempt in range(Repository.PushRetries + 1):
+      process = subprocess.Popen(
+        command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        close_fds=True
+      )
+      stream = FrameStream(process.stdout, process.stdin)
+      try:
+        with span('subprocess:push', command=command):
+          results = self._send_stream(stream, manifest, files, progress)
+        break
+      except StreamError, ex:
+        if attempt == Repository.PushRetries: raise
+        self.logger.warning(
+          'push of [%s] interrupted (%s), resuming' % (path, ex)
+        )
+      finally:
+        sent += stream.sent
+        for pipe in (process.stdin, process.stdout):
+          try: pipe.close()
+          except IOError: pass
+        process.wait()
+
+    self._log('pushed [%s] through [%s]' % (path, command))
+    return results, sent
+
+  def _get_push_nodes(self, path):
+    self._get_valid_dependency(path)
+    nodes = [
+      (node, self._load(os.path.join(self.path, node)))
+        for node in self.get_dependency_graph().get_order([path])
+    ]
+    undeployed = [
+      node for node, metafile in nodes
+        if _RepoRelease.Type == metafile.get_type() and not metafile.deployed
+    ]
+    if undeployed:
+      raise ArgumentError(
+        'cannot push undeployed [%s]' % ', '.join(undeployed)
+      )
+    return nodes
+
+  def _get_manifest(self, path, files):
+    # ['d', path, mode], ['l', path, linkto] or ['f', path, key, size, mtime]
+    # for everything in the release's bin/ folder, noting a copy of each
+    # file's content in files
+    bin = self._get_srcbin(path)[1]
+    manifest = []
+    for dirpath, dirnames, filenames in os.walk(bin):
+      dirnames.sort()
+      for name in dirnames + sorted(filenames):
+        fullpath = os.path.join(dirpath, name)
+        relpath = os.path.relpath(fullpath, bin)
+        filestat = os.lstat(fullpath)
+        if stat.S_ISLNK(filestat.st_mode):
+          manifest.append(['l', relpath, os.readlink(fullpath)])
+        elif stat.S_ISDIR(filestat.st_mode):
+          manifest.append(['d', relpath, stat.S_IMODE(filestat.st_mode)])
+        else:
+          key = self.store.get_key(fullpath)
+          files.setdefault(key, fullpath)
+          manifest.append(
+            ['f', relpath, key, filestat.st_size, filestat.st_mtime]
+          )
+      dirnames[:] = [
+        d for d in dirnames if not os.path.islink(os.path.join(dirpath, d))
+      ]
+    return manifest
+
+  def _send_stream(self, stream, manifest, files, progress):
+    stream.send_json('H', manifest, True)
+    wanted = _decode(json.loads(stream.receive('W')[1]))
+    total = sum(os.path.getsize(files[key]) - offset for key, offset in wanted)
+    done = 0
+    for index, (key, offset) in enumerate(wanted):
+      with open(files[key], 'rb') as source:
+        source.seek(offset)
+        for chunk in iter(lambda: source.read(FrameStream.ChunkSize), ''):
+          stream.send('D', pack_chunk(index, offset, chunk))
+          offset += len(chunk)
+          done += len(chunk)
+          if not None is progress: progress(done, total)
+    stream.send('E', flush=True)
+    return [tuple(r) for r in _decode(json.loads(stream.receive('R')[1]))]
+
+  def receive(self, instream, outstream):
+    '''
+      The far end of push_stream: reads a push from instream, asks for the
+      content the repository lacks and applies it as push does, replying on
+      outstream. Content is received into IncomingDirName, where a file cut
+      short by a broken stream is kept to be resumed by the next push.
+    '''
+    stream = FrameStream(instream, outstream)
+    try:
+      manifest = _decode(json.loads(stream.receive('H')[1]))
+      self._check_manifest(manifest)
+      wanted, sizes = self._get_wanted(manifest['nodes'])
+      stream.send_json('W', wanted, True)
+      self._receive_files(stream, wanted, sizes)
+      results = self._apply_manifest(manifest, sizes)
+    except StreamError, ex:
+      raise # the other end is gone, or isn't talking sense
+    except RepoError, ex:
+      try: stream.send_json('X', str(ex), True)
+      except StreamError: pass
+      raise
+    stream.send_json('R', results, True)
+    self._log(
+      'received [%s]: %d bytes in %d files'
+        % (manifest['path'], stream.received, len(wanted))
+    )
+    return results
+
+  def _check_manifest(self, manifest):
+    # receive runs as the evolve user on behalf of whoever is pushing, so
+    # nothing in the manifest is used until it's known to stay in the repo
+    def _fail(what):
+      raise RepoError('malformed push manifest: %s' % what)
+
+    root = os.path.join(os.path.realpath(self.path), '')
+    def _check_path(path, what):
+      # a repository path, which can't be hidden (like .evolve) either
+      if not _is_relative(path) \
+        or [p for p in path.split('/') if p.startswith('.')] \
+        or not os.path.realpath(os.path.join(root, path)).startswith(root):
+        _fail('%s [%r]' % (what, path))
+
+    if not isinstance(manifest, dict) \
+      or not isinstance(manifest.get('nodes'), list):
+      _fail('no nodes')
+    _check_path(manifest.get('path'), 'path')
+    for node in manifest['nodes']:
+      if not isinstance(node, dict): _fail('node')
+      if not node.get('type') in (_RepoRelease.Type, _RepoRlink.Type):
+        _fail('node type [%r]' % (node.get('type'),))
+      _check_path(node.get('path'), 'node path')
+      if not isinstance(node.get('dependencies'), list): _fail('dependencies')
+      for dependency in node['dependencies']:
+        _check_path(dependency, 'dependency')
+      if _RepoRlink.Type == node['type']:
+        _check_path(node.get('target'), 'rlink target')
+        continue
+      if not isinstance(node.get('files'), list): _fail('files')
+      # each entry sits in a directory listed before it, so none is staged
+      # through a symlink (or a file)
+      dirs, seen = set(['']), set()
+      for entry in node['files']:
+        if not isinstance(entry, list) or 3 > len(entry): _fail('entry')
+        kind, relpath = entry[0], entry[1]
+        if not _is_relative(relpath) or relpath in seen \
+          or not os.path.dirname(relpath) in dirs:
+          _fail('file path [%r]' % (relpath,))
+        seen.add(relpath)
+        if 'd' == kind and isinstance(entry[2], int):
+          dirs.add(relpath)
+        elif 'l' == kind and isinstance(entry[2], str) and entry[2] \
+          and not '\0' in entry[2]:
+          pass
+        elif 'f' != kind or 5 != len(entry) \
+          or not re.match(r'^[0-9a-f]{40}\.[0-7]+$', str(entry[2])) \
+          or not isinstance(entry[3], (int, long)) or 0 > entry[3] \
+          or not isinstance(entry[4], (int, long, float)):
+          _fail('entry for [%s]' % relpath)
+
+  def _get_incoming_path(self, name):
+    return os.path.join(self.path, Repository.IncomingDirName, name)
+
+  def _has_content(self, key):
+    return (self.store.exists() and self.store.contains(key)) \
+      or os.path.exists(self._get_incoming_path(key))
+
+  def _get_wanted(self, nodes):
+    # [key, offset] for each file content still needed, and the sizes of all
+    # of them
+    incoming = self._get_incoming_path('')
+    if not os.path.isdir(incoming): os.makedirs(incoming)
+
+    sizes = { }
+    for node in nodes:
+      if _RepoRelease.Type != node['type'] or self._is_deployed(node['path']):
+        continue
+      for entry in node['files']:
+        if 'f' == entry[0]: sizes[entry[2]] = entry[3]
+
+    wanted = []
+    for key, size in sorted(sizes.iteritems()):
+      if self._has_content(key): continue
+      partial = self._get_incoming_path(key + '.part')
+      offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+      if 0 == size or offset >= size:
+        if os.path.exists(partial): os.remove(partial)
+        if 0 == size:
+          open(self._get_incoming_path(key), 'wb').close()
+          continue
+        offset = 0
+      wanted.append([key, offset])
+    return wanted, sizes
+
+  def _receive_files(self, stream, wanted, sizes):
+    current, target, position = None, None, 0
+    try:
+      while True:
+        kind, data = stream.receive('D', 'E')
+        if 'E' == kind: break
+        index, offset, chunk = unpack_chunk(data)
+        key = wanted[index][0]
+        partial = self._get_incoming_path(key + '.part')
+        if index != current:
+          if not None is target: target.close()
+          current, target = index, open(partial, 'ab')
+          position = os.path.getsize(partial)
+        if offset != position:
+          raise StreamError(
+            'chunk of [%s] at [%d] where [%d] was expected'
+              % (key, offset, position)
+          )
+        target.write(chunk)
+        position += len(chunk)
+        if position == sizes[key]:
+          target.close()
+          current, target = None, None
+          if hash_file(partial) != key.split('.')[0]:
+            os.remove(partial)
+            raise StreamError('content of [%s] does not match' % key)
+          os.rename(partial, self._get_incoming_path(key))
+    finally:
+      if not None is target: target.close()
+
+    missing = [key for key, offset in wanted if not self._has_content(key)]
+    if missing:
+      raise StreamError('stream ended without [%d] files' % len(missing))
+
+  def _apply_manifest(self, manifest, sizes):
+    staging = self._get_incoming_path('stage.%d' % os.getpid())
+    results = []
+    try:
+      with self.transaction():
+        for node in manifest['nodes']:
+          if _RepoRlink.Type == node['type']:
+            path, action, stats = self._receive_rlink(
+              node['path'], node['target'], node['dependencies'],
+              node['path'] == manifest['path']
+            )
+          else:
+            bin = os.path.join(staging, node['path'])
+            if not self._is_deployed(node['path']):
+              self._stage(bin, node['files'])
+            path, action, stats = self._receive_release(
+              node['path'], node['dependencies'], bin, False, 1, None
+            )
+          results.append((path, action, None if None is stats else str(stats)))
+    finally:
+      if os.path.exists(staging): do_or_die('rm -rf ' + staging)
+
+    # everything received is in the releases (and the store) now
+    for key in sizes:
+      if os.path.exists(self._get_incoming_path(key)):
+        os.remove(self._get_incoming_path(key))
+    return results
+
+  def _stage(self, bin, entries):
+    # lays out a release's bin/ folder from the store and received content,
+    # for _receive_release to sync from
+    os.makedirs(bin)
+    dirs = []
+    for entry in entries:
+      target = os.path.join(bin, entry[1])
+      if 'd' == entry[0]:
+        os.mkdir(target)
+        dirs.append((target, entry[2]))
+      elif 'l' == entry[0]:
+        os.symlink(entry[2], target)
+      elif self.store.exists() and self.store.contains(entry[2]):
+        self.store.link(entry[2], target)
+      else:
+        source = self._get_incoming_path(entry[2])
+        try: os.link(source, target)
+        except OSError, ex:
+          if errno.EXDEV != ex.errno: raise
+          copy_file(source, target)
+        os.chmod(target, int(entry[2].split('.')[1], 8))
+        os.utime(target, (entry[4], entry[4]))
+    # once they're filled, in case they aren't writable
+    for target, mode in reversed(dirs): os.chmod(target, mode)
+
+  def _is_deployed(self, path):
+    fullpath = os.path.join(self.path, path)
+    if not os.path.exists(fullpath): return False
+    metafile = self._get_header(fullpath)
+    return _RepoRelease.Type == metafile.get_type() and metafile.deployed
+
+  def _receive_release(
+    self, path, dependencies, bin, checksum, jobs, progress
+  ):
+    fullpath = os.path.join(self.path, path)
+    if os.path.exists(fullpath):
+      existing = self._get_header(fullpath)
+      if not _RepoRelease.Type == existing.get_type():
+        raise ArgumentError(
+          'path [%s] in [%s] does not correspond to a release'
+            % (path, self.path)
+        )
+      if existing.deployed: return path, 'present', None
+    else:
+      if not os.path.exists(os.path.dirname(fullpath)):
+        self.create_project(os.path.dirname(path))
+      self.create_release(path)
+
+    try:
+      with self._lock(fullpath):
+        target = os.path.join(fullpath, 'bin')
+        self._txn.backup(target)
+        stats = sync_tree(
+          bin, target, checksum, self.store if self.store.exists() else None,
+          jobs, progress
+        )
+    except _RepoLock.LockError, ex:
+      raise RepoError('release at [%s] is locked' % path)
+    self._log('received [%s]: %s' % (path, stats))
+
+    self._mirror_dependencies(path, dependencies)
+    self.deploy(path)
+    return path, 'pushed', stats
+
+  def _receive_rlink(self, path, target, dependencies, retarget):
+    fullpath = os.path.join(self.path, path)
+    name = os.path.basename(path)
+    if not os.path.exists(fullpath):
+      self.create_rlink(target, name)
+      action = 'created'
+    else:
+      existing = self._get_header(fullpath)
+      if not _RepoRlink.Type == existing.get_type():
+        raise ArgumentError(
+          'path [%s] in [%s] does not correspond to an rlink'
+            % (path, self.path)
+        )
+      if not retarget or existing.target == target:
+        return path, 'present', None
+      self.update_rlink(target, name)
+      action = 'retargeted'
+
+    self._mirror_dependencies(path, dependencies)
+    return path, action, None
+
+  def _mirror_dependencies(self, path, dependencies):
+    current = self._load(os.path.join(self.path, path)).dependencies
+    extra = [d for d in current if not d in dependencies]
+    missing = [d for d in dependencies if not d in current]
+    if extra: self.remove_dependencies(path, *extra)
+    if missing: self.add_dependencies(path, *missing)
+
+  def _imap_parallel(self, fn, items, jobs):
+    # calls fn(repo, item) for each item on up to `jobs' threads, each with a
+    # repository (and index connection) of its own. A transaction is tied to
+    # this repository, so inside one they all run here in turn.
+    if not None is self._txn: jobs = 1
+    local = threading.local()
+    def _call(item):
+      if 1 >= jobs: return fn(self, item)
+      if not hasattr(local, 'repo'): local.repo = Repository(self.path)
+      return fn(local.repo, item)
+    return imap_parallel(_call, items, jobs)
+
+  def init_store(self):
+    '''
+      Creates the repository's object store. Subsequent installs hardlink
+      their artifacts from it, and deploys make the artifacts read-only.
+    '''
+    if self.store.exists():
+      raise ArgumentError('repository already has an object store')
+    self.store.create()
+    self.logger.info('created object store')
+
+  def get_store_stats(self):
+    if not self.store.exists():
+      raise ArgumentError('repository has no object store')
+    return self.store.get_stats()
+
+  def prune_store(self):
+    if not self.store.exists():
+      raise ArgumentError('repository has no object store')
+    removed = self.store.prune()
+    self.logger.info('pruned [%d] blobs from object store' % removed)
+    return removed
+
+  def clean(self, path, recursive=False):
+    '''
+      Removes what crashed processes left behind at path (and, if recursive,
+      at every location beneath it): lock files, fifo tickets and partially
+      written metafiles. Locks whose owner died are taken over first. Returns
+      the number of locations cleaned and the (path, owner) of those still
+      locked by running processes.
+    '''
     path = path.strip().strip('/')
     fullpath = os.path.join(self.path, path)
     if not os.path.exists(fullpath):
       raise ArgumentError('repository location not found: [%s]' % path)
-    with _RepoLock(fullpath, True): pass
+
+    paths = [path]
+    if recursive:
+      paths = sorted(
+        row['path'] for row in self._get_index().get_subtree(path)
+      )
+
+    cleaned, busy = 0, []
+    for node in paths:
+      fullpath = os.path.join(self.path, node)
+      try:
+        with _RepoLock(fullpath, timeout=0, fifo=False, logger=self.logger):
+          self._clean(fullpath)
+        cleaned += 1
+      except _RepoLock.LockError, ex:
+        busy.append((node, _RepoLock.get_owner(fullpath)))
+
+    self.logger.info(
+      'cleaned [%d] locations, [%d] in use' % (cleaned, len(busy))
+    )
+    return cleaned, busy
+
+  def _clean(self, fullpath):
+    for name in os.listdir(fullpath):
+      if name.startswith(_RepoLock.TicketPrefix):
+        _RepoLock.remove_stale_ticket(fullpath, name)
+      elif name.endswith(TempSuffix):
+        os.remove(os.path.join(fullpath, name))
+    # waiters that opened this file will notice it's gone and use a new one
+    os.remove(os.path.join(fullpath, _RepoLock.RepoLockFileName))
 
   def _get_valid_project_parent_path(self, path):
     if '' == path:
@@ -419,7 +2071,7 @@ class Repository(object):
       
     path = os.path.join(self.path, path)
     if os.path.exists(path):
-      metafile = _RepoMetaFile.load(path)
+      metafile = self._get_header(path)
       raise ArgumentError(
         'project path corresponds to existing ' + metafile.get_type()
       )
@@ -427,8 +2079,12 @@ class Repository(object):
     sepidx = path.rfind('/')
     while -1 != sepidx:
       parent = path[:sepidx]
-      if os.path.exists(parent):
-        metafile = _RepoMetaFile.load(parent)
+      # a project still being created by someone else has no metafile yet;
+      # its parent is locked until it does. Ours may be waiting to be written
+      # by the transaction.
+      if _RepoMetaFile.exists(parent) \
+        or (not None is self._txn and parent in self._txn.metafiles):
+        metafile = self._load(parent)
         if not metafile.accepts_project():
           raise ArgumentError('invalid project location')
         result = (parent, metafile)
@@ -437,17 +2093,18 @@ class Repository(object):
 
     return result
 
-  def _create_project(self, parent, projects):
+  def _create_project(self, parent, projects, created):
     projpath = os.path.join(parent, projects[0])
     os.makedirs(projpath)
-    with _RepoLock(projpath): # should not fail at this point
+    with self._lock(projpath): # should not fail at this point
       metafile = _RepoProject()
       try:
         if 1 < len(projects): 
-          self._create_project(projpath, projects[1:])
+          self._create_project(projpath, projects[1:], created)
           metafile.projects.append(projects[1])
       finally:
-        metafile.save(projpath)
+        self._save(projpath, metafile)
+        created.append((projpath, metafile))
 
   def _get_valid_project_and_release(self, path):
     if '' == path or -1 == path.find('/'):
@@ -464,7 +2121,7 @@ class Repository(object):
     if not re.match(r'\w[\w\-_\.]*', release):
       raise ArgumentError('illegal release name: [%s]' % release)
  
-    metafile = _RepoMetaFile.load(project)
+    metafile = self._load(project)
     if not metafile.accepts_release():
       raise ArgumentError('invalid release location')
 
@@ -479,11 +2136,13 @@ class Repository(object):
     src, bin = self._get_srcbin(
       os.path.join(projectpath.replace(self.path, ''), release).strip('/')
     )
-    with _RepoLock(releasepath): # should not fail at this point
+    with self._lock(releasepath): # should not fail at this point
       os.makedirs(src)
       os.chmod(src, 0775)
       os.makedirs(bin)
-      _RepoRelease().save(releasepath)
+      metafile = _RepoRelease()
+      self._save(releasepath, metafile)
+    return metafile
 
   def _get_srcbin(self, path):
     releasepath = os.path.join(self.path, path)
@@ -511,7 +2170,7 @@ class Repository(object):
 
     namepath = os.path.join(project, name)
     if os.path.exists(namepath):
-      metafile = _RepoMetaFile.load(namepath)
+      metafile = self._get_header(namepath)
       raise ArgumentError(
         'name corresponds to existing %s %s' % (
           metafile.get_type(),
@@ -520,7 +2179,7 @@ class Repository(object):
         )
       )
  
-    metafile = _RepoMetaFile.load(project)
+    metafile = self._load(project)
     if not metafile.accepts_rlink():
       raise ArgumentError('invalid rlink location')
 
@@ -538,23 +2197,32 @@ class Repository(object):
     if not os.path.exists(rlink):
       raise ArgumentError('rlink not found: [%s]' % name)
 
-    releasemetafile = _RepoMetaFile.load(release)
+    releasemetafile = self._get_header(release)
     if not _RepoRelease.Type == releasemetafile.get_type():
       raise ArgumentError('path [%s] does not correspond to a release' % path)
 
-    rlinkmetafile = _RepoMetaFile.load(rlink)
+    rlinkmetafile = self._load(rlink)
     if not _RepoRlink.Type == rlinkmetafile.get_type():
       raise ArgumentError('path [%s] does not correspond to an rlink' % path)
 
+    rlinkrelpath = self._get_relpath(rlink)
+    graph = self.get_dependency_graph()
+    if path in graph.get_dependents(rlinkrelpath, True):
+      raise ArgumentError(
+        'targeting [%s] would make a cycle with [%s]' % (path, rlinkrelpath)
+      )
+
     return rlink, rlinkmetafile
 
   def _create_rlink(self, projectpath, release, rlink):
     releasepath = os.path.join(projectpath, release.split('/')[-1])
     rlinkpath = os.path.join(projectpath, rlink)
     os.makedirs(rlinkpath)
-    with _RepoLock(rlinkpath): # should not fail at this point
+    with self._lock(rlinkpath): # should not fail at this point
       os.symlink(os.path.join(releasepath,'bin'), os.path.join(rlinkpath,'bin'))
-      _RepoRlink(release).save(rlinkpath)
+      metafile = _RepoRlink(release)
+      self._save(rlinkpath, metafile)
+    return metafile
 
   def _get_valid_paths_for_install(self, path, artifactpath):
     releasepath = os.path.join(self.path, path)
@@ -562,7 +2230,7 @@ class Repository(object):
     if not os.path.exists(releasepath):
       raise ArgumentError('release not found: [%s]' % path)
 
-    releasemetafile = _RepoMetaFile.load(releasepath)
+    releasemetafile = self._get_header(releasepath)
     if not _RepoRelease.Type == releasemetafile.get_type():
       raise ArgumentError('path [%s] does not correspond to a release' % path)
 
@@ -576,6 +2244,12 @@ class Repository(object):
       raise ArgumentError(
         'build artifact path not found: [%s/src/%s]' % (path, artifactpath)
       )
+
+    if not os.path.isdir(fullartpath):
+      raise ArgumentError(
+        'build artifact path is not a directory: [%s/src/%s]'
+          % (path, artifactpath)
+      )
     
     return bin, fullartpath
 
@@ -584,7 +2258,7 @@ class Repository(object):
     if not os.path.exists(fullpath):
       raise ArgumentError('release not found: [%s]' % path)
 
-    releasemetafile = _RepoMetaFile.load(fullpath)
+    releasemetafile = self._load(fullpath)
     if not _RepoRelease.Type == releasemetafile.get_type():
       raise ArgumentError('path [%s] does not correspond to a release' % path)
 
@@ -595,4 +2269,87 @@ class Repository(object):
     if 0 == len(os.listdir(bin)):
       raise ArgumentError('no build artifacts installed for release [%s]'%path)
 
+    undeployed = self._get_undeployed_dependencies(path)
+    if undeployed:
+      raise ArgumentError(
+        'release [%s] depends on undeployed [%s]'
+          % (path, ', '.join(undeployed))
+      )
+
     return fullpath, releasemetafile, src
+
+  def _get_undeployed_dependencies(self, path):
+    undeployed = []
+    for dependency in self.get_dependency_graph().get_dependencies(path, True):
+      fullpath = os.path.join(self.path, dependency)
+      if not os.path.exists(fullpath):
+        undeployed.append(dependency)
+        continue
+      metafile = self._get_header(fullpath)
+      if _RepoRelease.Type == metafile.get_type() and not metafile.deployed:
+        undeployed.append(dependency)
+    return undeployed
+
+  def _get_valid_dependency(self, path):
+    fullpath = os.path.join(self.path, path)
+    if '' == path or not os.path.exists(fullpath):
+      raise ArgumentError('release or rlink not found: [%s]' % path)
+
+    metafile = self._get_header(fullpath)
+    if not metafile.get_type() in (_RepoRelease.Type, _RepoRlink.Type):
+      raise ArgumentError(
+        'path [%s] does not correspond to a release or rlink' % path
+      )
+
+    return fullpath
+
+  def _get_valid_node_for_dependencies(self, path, dependencies, add):
+    if 0 == len(dependencies):
+      raise ArgumentError('no dependencies specified')
+
+    fullpath = self._get_valid_dependency(path)
+    metafile = self._load(fullpath)
+    if _RepoRelease.Type == metafile.get_type() and metafile.deployed:
+      raise ArgumentError('release [%s] is locked and deployed' % path)
+
+    if not add:
+      for dependency in dependencies:
+        if not dependency in metafile.dependencies:
+          raise ArgumentError(
+            '[%s] does not depend on [%s]' % (path, dependency)
+          )
+      return fullpath, metafile
+
+    graph = self.get_dependency_graph()
+    dependents = set(graph.get_dependents(path, True))
+    for dependency in dependencies:
+      self._get_valid_dependency(dependency)
+      if dependency == path or dependency in dependents:
+        raise ArgumentError(
+          'depending on [%s] would make a cycle with [%s]' % (dependency, path)
+        )
+    return fullpath, metafile
+
+_repos = { }
+
+def get_repository(path):
+  '''
+    Returns a shared Repository for path, so long-running processes (the
+    shell, evolved) keep its index and caches warm between commands.
+  '''
+  path = path.strip().rstrip('/')
+  if not path in _repos: _repos[path] = Repository(path)
+  return _repos[path]
+
+def after_fork():
+  '''
+    Called in a forked child of a process with shared repositories, which
+    then open index connections of their own. An SQLite connection can't be
+    used on both sides of a fork; the parent's are kept rather than closed,
+    as closing them here could disturb the parent's use of the database.
+  '''
+  for repo in _repos.values():
+    if not None is repo._index: _forked.append(repo._index)
+    repo._index = None
+
+_forked = []
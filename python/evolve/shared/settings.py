@@ -0,0 +1,51 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+  Process-wide settings for repository operations. They live apart from repo
+  so that the command line can set them without loading it for commands that
+  never open a repository.
+'''
+
+__author__ = 'Will Leszczuk'
+
+lock_wait = (0, False)
+history_retention = None
+
+def set_lock_wait(timeout, fifo=False):
+  '''
+    Sets how many seconds repository locks wait for a busy node before giving
+    up, and whether waiters are served in the order they arrived.
+  '''
+  global lock_wait
+  lock_wait = (timeout, fifo)
+
+def set_history_retention(entries=None):
+  '''
+    Sets how many entries rlink histories keep when they're compacted, or
+    restores the default.
+  '''
+  global history_retention
+  history_retention = entries
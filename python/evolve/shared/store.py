@@ -0,0 +1,169 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+  A content-addressed store of build artifacts at the repository root.
+  Installed files are hardlinked to their blob in the store, so identical
+  artifacts in different releases share a single copy on disk.
+
+  Blobs are keyed by the SHA-1 of their contents and their permission bits
+  (less the write bits, which deploy removes), since hardlinks share both.
+  They are never modified once written: files are replaced by linking a
+  different blob over them.
+'''
+
+__author__ = 'Will Leszczuk'
+
+import os, errno, stat, time, thread
+from evolve.shared.sync import hash_file, copy_file, TempSuffix
+
+class ObjectStore(object):
+  StoreDirName = os.path.join('.evolve', 'objects')
+  PruneGraceSeconds = 3600
+  _TempDirName = 'tmp'
+
+  def __init__(self, root):
+    self.path = os.path.join(root, ObjectStore.StoreDirName)
+
+  def exists(self):
+    return os.path.isdir(self.path)
+
+  def create(self):
+    os.makedirs(os.path.join(self.path, ObjectStore._TempDirName))
+
+  def get_key(self, path, digest=None):
+    mode = stat.S_IMODE(os.stat(path).st_mode) & ~0222
+    return '%s.%o' % (digest or hash_file(path), mode)
+
+  def get_path(self, key):
+    return os.path.join(self.path, key[:2], key[2:])
+
+  def contains(self, key):
+    return os.path.exists(self.get_path(key))
+
+  def add(self, srcpath, key=None):
+    '''
+      Adds srcpath to the store if its contents aren't already there. Returns
+      the key of the blob and the number of bytes written.
+    '''
+    key = key or self.get_key(srcpath)
+    blobpath = self.get_path(key)
+    if os.path.exists(blobpath): return key, 0
+
+    if not os.path.isdir(os.path.dirname(blobpath)):
+      try: os.makedirs(os.path.dirname(blobpath))
+      except OSError, ex:
+        if errno.EEXIST != ex.errno: raise
+    # copy under a private name first, so a blob is never seen half-written
+    temppath = os.path.join(
+      self.path,
+      ObjectStore._TempDirName,
+      '%s.%d.%d' % (key, os.getpid(), thread.get_ident())
+    )
+    size = copy_file(srcpath, temppath)
+    os.rename(temppath, blobpath)
+    return key, size
+
+  def link(self, key, dstpath):
+    '''
+      Replaces dstpath with a hardlink to the blob. Falls back to a copy if
+      dstpath is on another filesystem. Returns the bytes copied, if any.
+    '''
+    blobpath = self.get_path(key)
+    temppath = os.path.join(
+      os.path.dirname(dstpath), '.' + os.path.basename(dstpath) + TempSuffix
+    )
+    if os.path.lexists(temppath): os.remove(temppath)
+    try: os.link(blobpath, temppath)
+    except OSError, ex:
+      if errno.EXDEV != ex.errno: raise
+      return copy_file(blobpath, dstpath)
+    os.rename(temppath, dstpath)
+    return 0
+
+  def install(self, srcpath, dstpath):
+    '''
+      Adds srcpath to the store and links dstpath to it. Returns the number of
+      bytes written.
+    '''
+    key, size = self.add(srcpath)
+    return size + self.link(key, dstpath)
+
+  def freeze(self, path):
+    '''
+      Removes the write permissions from every file under path. For files
+      linked into the store this makes the blobs themselves read-only.
+    '''
+    for dirpath, dirnames, filenames in os.walk(path):
+      for name in filenames:
+        filepath = os.path.join(dirpath, name)
+        filestat = os.lstat(filepath)
+        if stat.S_ISREG(filestat.st_mode):
+          os.chmod(
+            filepath,
+            stat.S_IMODE(filestat.st_mode)
+              & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+          )
+
+  def get_stats(self):
+    '''
+      Returns the number of blobs, their total size, and the number and size
+      of blobs no longer linked from any release.
+    '''
+    blobs, size, unused, unusedsize = 0, 0, 0, 0
+    for blobpath in self._get_blobs():
+      blobstat = os.lstat(blobpath)
+      blobs += 1
+      size += blobstat.st_size
+      if 1 == blobstat.st_nlink:
+        unused += 1
+        unusedsize += blobstat.st_size
+    return blobs, size, unused, unusedsize
+
+  def prune(self):
+    '''
+      Deletes blobs no longer linked from any release, along with abandoned
+      temporary files. Anything touched within the grace period is kept, as
+      it may belong to an install in progress. Returns the number of blobs
+      removed.
+    '''
+    removed = 0
+    cutoff = time.time() - ObjectStore.PruneGraceSeconds
+    for blobpath in self._get_blobs():
+      blobstat = os.lstat(blobpath)
+      if 1 == blobstat.st_nlink and blobstat.st_ctime < cutoff:
+        os.remove(blobpath)
+        removed += 1
+    tempdir = os.path.join(self.path, ObjectStore._TempDirName)
+    for name in os.listdir(tempdir):
+      if os.lstat(os.path.join(tempdir, name)).st_ctime < cutoff:
+        os.remove(os.path.join(tempdir, name))
+    return removed
+
+  def _get_blobs(self):
+    for prefix in os.listdir(self.path):
+      if ObjectStore._TempDirName == prefix: continue
+      for name in os.listdir(os.path.join(self.path, prefix)):
+        yield os.path.join(self.path, prefix, name)
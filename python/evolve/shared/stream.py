@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+'''
+  Framing for the byte streams `evolve push --pipe' talks over, such as the
+  stdin and stdout of an `evolve receive' on the far end of ssh.
+
+  A frame is a one byte kind, a one byte set of flags, the four byte
+  big-endian length of the payload as sent, and the CRC-32 of the payload
+  before compression, followed by the payload. Flag 1 marks a payload
+  compressed with zlib; payloads are only sent compressed when that makes
+  them smaller. The checksum is verified after decompression, so it covers
+  the data end to end. An 'X' frame carries an error message from the
+  other end. File contents travel in chunks of at most ChunkSize bytes,
+  each prefixed with the four byte index of its file and the eight byte
+  offset of the chunk within it.
+'''
+
+__author__ = 'Will Leszczuk'
+
+import struct, zlib, json
+from evolve.shared.errors import RepoError
+
+class StreamError(RepoError): pass
+class RemoteError(RepoError): pass
+
+def pack_chunk(index, offset, data):
+  return FrameStream._Chunk.pack(index, offset) + data
+
+def unpack_chunk(data):
+  size = FrameStream._Chunk.size
+  index, offset = FrameStream._Chunk.unpack(data[:size])
+  return index, offset, data[size:]
+
+class FrameStream(object):
+  ChunkSize = 256 * 1024
+  CompressLevel = 1
+  _Header = struct.Struct('!cBII')
+  _Chunk = struct.Struct('!IQ')
+  _Compressed = 1
+
+  def __init__(self, instream, outstream, compress=True):
+    self.instream = instream
+    self.outstream = outstream
+    self.compress = compress
+    self.sent = 0
+    self.received = 0
+
+  def send(self, kind, data='', flush=False):
+    crc = zlib.crc32(data) & 0xffffffff
+    flags = 0
+    if self.compress and 0 < len(data):
+      packed = zlib.compress(data, FrameStream.CompressLevel)
+      if len(packed) < len(data): data, flags = packed, FrameStream._Compressed
+    try:
+      self.outstream.write(
+        FrameStream._Header.pack(kind, flags, len(data), crc) + data
+      )
+      if flush: self.outstream.flush()
+    except IOError, ex:
+      raise StreamError('stream closed while sending: %s' % ex.strerror)
+    self.sent += FrameStream._Header.size + len(data)
+
+  def send_json(self, kind, value, flush=False):
+    self.send(kind, json.dumps(value), flush)
+
+  def receive(self, *kinds):
+    '''
+      Returns the (kind, payload) of the next frame. If kinds are given and
+      the frame is none of them, raises StreamError, or RemoteError with
+      the message of an error frame if that's what it is.
+    '''
+    header = self._read(FrameStream._Header.size)
+    kind, flags, length, crc = FrameStream._Header.unpack(header)
+    data = self._read(length)
+    self.received += len(header) + length
+    if flags & FrameStream._Compressed:
+      try: data = zlib.decompress(data)
+      except zlib.error, ex: raise StreamError('corrupt frame: %s' % ex)
+    if crc != zlib.crc32(data) & 0xffffffff:
+      raise StreamError('checksum mismatch in [%s] frame' % kind)
+    if kinds and not kind in kinds:
+      if 'X' == kind: raise RemoteError(json.loads(data).encode('utf-8'))
+      raise StreamError('unexpected [%s] frame' % kind)
+    return kind, data
+
+  def _read(self, size):
+    chunks, remaining = [], size
+    while 0 < remaining:
+      chunk = self.instream.read(remaining)
+      if not chunk: raise StreamError('stream closed while receiving')
+      chunks.append(chunk)
+      remaining -= len(chunk)
+    return ''.join(chunks)
@@ -0,0 +1,246 @@
+#!/usr/bin/python
+
+# Copyright (c) 2010 William Leszczuk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+  Synchronizes a release's bin/ folder with a tree of build artifacts in
+  process: files that are unchanged (by size and mtime, or by content when
+  checksumming) are left alone, changed files are copied, and files that no
+  longer exist in the source are deleted.
+
+  Files are never rewritten in place - each copy goes to a temporary file
+  that is then renamed over the target, so readers of the old file (and any
+  hardlinks to it) are unaffected.
+
+  The source is walked lazily in the calling thread, which also takes care of
+  directories, symlinks and deletions; comparing and copying regular files
+  can be fanned out to a pool of worker threads.
+'''
+
+__author__ = 'Will Leszczuk'
+
+import os, stat, shutil, hashlib, time
+from evolve.shared.util import format_bytes, imap_parallel
+from evolve.shared.instrument import timed
+
+TempSuffix = '.evolvetmp'
+_BufferSize = 1024 * 1024
+
+class SyncStats(object):
+  def __init__(self):
+    self.copied = 0
+    self.linked = 0
+    self.bytes = 0
+    self.unchanged = 0
+    self.removed = 0
+    self.start = time.time()
+    self.elapsed = 0
+
+  def add(self, outcome, size):
+    setattr(self, outcome, 1 + getattr(self, outcome))
+    self.bytes += size
+
+  def get_files(self):
+    return self.copied + self.linked + self.unchanged
+
+  def get_elapsed(self):
+    return self.elapsed or time.time() - self.start
+
+  def get_rate(self):
+    return self.bytes / max(self.get_elapsed(), 0.001)
+
+  def finish(self):
+    self.elapsed = time.time() - self.start
+    return self
+
+  def __str__(self):
+    return '%scopied %d files (%s), %d unchanged, %d removed ' \
+      'in %.2fs (%.0f files/s, %s/s)' % (
+      'linked %d files, ' % self.linked if self.linked else '',
+      self.copied, format_bytes(self.bytes), self.unchanged, self.removed,
+      self.elapsed, self.get_files() / max(self.elapsed, 0.001),
+      format_bytes(self.get_rate())
+    )
+
+@timed('sync_tree')
+def sync_tree(src, dst, checksum=False, store=None, jobs=1, progress=None):
+  '''
+    Makes dst a copy of src, returning a SyncStats describing the work done.
+    If an ObjectStore is supplied, changed files are added to it and
+    hardlinked into dst rather than copied. Files are processed by `jobs'
+    threads; progress, if supplied, is called with the SyncStats after each.
+  '''
+  stats = SyncStats()
+  if not os.path.isdir(dst): os.makedirs(dst)
+
+  def _process(paths):
+    return _sync_file(paths[0], paths[1], checksum, store)
+
+  for outcome, size in imap_parallel(_process, _scan(src, dst, stats), jobs):
+    stats.add(outcome, size)
+    if not None is progress: progress(stats)
+
+  return stats.finish()
+
+def _scan(src, dst, stats):
+  '''
+    Walks src, bringing dst's directories, symlinks and deletions in line,
+    and yields the (source, target) paths of the regular files to sync.
+  '''
+  for dirpath, dirnames, filenames in os.walk(src):
+    target = os.path.join(dst, os.path.relpath(dirpath, src))
+    names = set(dirnames + filenames)
+
+    for name in os.listdir(target):
+      if not name in names:
+        _remove(os.path.join(target, name))
+        stats.removed += 1
+
+    for name in list(dirnames):
+      srcpath, dstpath = os.path.join(dirpath, name), os.path.join(target, name)
+      if os.path.islink(srcpath):
+        dirnames.remove(name)
+        stats.add(_sync_link(srcpath, dstpath), 0)
+      elif not os.path.isdir(dstpath) or os.path.islink(dstpath):
+        if os.path.lexists(dstpath): _remove(dstpath)
+        os.mkdir(dstpath)
+        shutil.copymode(srcpath, dstpath)
+
+    for name in filenames:
+      srcpath, dstpath = os.path.join(dirpath, name), os.path.join(target, name)
+      if os.path.islink(srcpath): stats.add(_sync_link(srcpath, dstpath), 0)
+      else: yield srcpath, dstpath
+
+def is_unchanged(srcstat, dstpath, checksum, srcpath=None):
+  try: dststat = os.lstat(dstpath)
+  except OSError: return False
+  if not stat.S_ISREG(dststat.st_mode) or srcstat.st_size != dststat.st_size:
+    return False
+  if checksum: return hash_file(srcpath) == hash_file(dstpath)
+  return int(srcstat.st_mtime) == int(dststat.st_mtime)
+
+def hash_file(path):
+  digest = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(_BufferSize), ''): digest.update(block)
+  return digest.hexdigest()
+
+def copy_file(srcpath, dstpath):
+  '''
+    Copies srcpath's contents, mode and times to dstpath via a temporary
+    file and a rename. Returns the number of bytes copied.
+  '''
+  temppath = os.path.join(
+    os.path.dirname(dstpath), '.' + os.path.basename(dstpath) + TempSuffix
+  )
+  try:
+    with open(srcpath, 'rb') as srcfile:
+      with open(temppath, 'wb') as dstfile:
+        size = _copy_data(srcfile, dstfile)
+    shutil.copystat(srcpath, temppath)
+    os.rename(temppath, dstpath)
+  except BaseException:
+    if os.path.lexists(temppath): os.remove(temppath)
+    raise
+  return size
+
+def _copy_data(srcfile, dstfile):
+  size = os.fstat(srcfile.fileno()).st_size
+  sendfile = getattr(os, 'sendfile', None)
+  if not None is sendfile and 0 < size:
+    offset = 0
+    try:
+      while offset < size:
+        sent = sendfile(dstfile.fileno(), srcfile.fileno(), offset, size-offset)
+        if 0 == sent: break
+        offset += sent
+      return offset
+    except OSError:
+      if 0 != offset: raise
+      # not supported for these files - fall back to copying through memory
+  shutil.copyfileobj(srcfile, dstfile, _BufferSize)
+  return size
+
+def replace_symlink(linkto, linkpath):
+  '''
+    Points the symlink at linkpath to linkto in a single rename, so there is
+    no moment at which linkpath doesn't exist.
+  '''
+  temppath = os.path.join(
+    os.path.dirname(linkpath), '.' + os.path.basename(linkpath) + TempSuffix
+  )
+  if os.path.lexists(temppath): os.remove(temppath)
+  os.symlink(linkto, temppath)
+  os.rename(temppath, linkpath)
+
+def touch_changed(oldroot, newroot):
+  '''
+    Updates the mtime of every file under newroot that differs from the file
+    at the same relative path under oldroot (by identity, size or mtime).
+    Files with other links, such as blobs in an object store, are copied
+    first so that only this tree sees the new mtime. Returns the number of
+    files touched.
+  '''
+  touched = 0
+  for dirpath, dirnames, filenames in os.walk(newroot):
+    olddir = os.path.join(oldroot, os.path.relpath(dirpath, newroot))
+    for name in filenames:
+      newpath = os.path.join(dirpath, name)
+      newstat = os.lstat(newpath)
+      if not stat.S_ISREG(newstat.st_mode): continue
+      try: oldstat = os.lstat(os.path.join(olddir, name))
+      except OSError: oldstat = None
+      if None is oldstat or not (
+        os.path.samestat(oldstat, newstat) or (
+          oldstat.st_size == newstat.st_size
+          and int(oldstat.st_mtime) == int(newstat.st_mtime)
+        )
+      ):
+        if 1 < newstat.st_nlink: copy_file(newpath, newpath)
+        os.utime(newpath, None)
+        touched += 1
+  return touched
+
+def _sync_file(srcpath, dstpath, checksum, store):
+  # runs on the worker threads - returns the outcome rather than touching the
+  # shared stats
+  srcstat = os.stat(srcpath)
+  if is_unchanged(srcstat, dstpath, checksum, srcpath): return 'unchanged', 0
+  if os.path.isdir(dstpath) and not os.path.islink(dstpath): _remove(dstpath)
+  if None is store: return 'copied', copy_file(srcpath, dstpath)
+
+  written = store.install(srcpath, dstpath)
+  return ('linked' if 0 == written else 'copied'), written
+
+def _sync_link(srcpath, dstpath):
+  linkto = os.readlink(srcpath)
+  if os.path.islink(dstpath) and os.readlink(dstpath) == linkto:
+    return 'unchanged'
+  if os.path.lexists(dstpath): _remove(dstpath)
+  os.symlink(linkto, dstpath)
+  return 'copied'
+
+def _remove(path):
+  if os.path.isdir(path) and not os.path.islink(path): shutil.rmtree(path)
+  else: os.remove(path)
@@ -30,12 +30,170 @@
 
 __author__ = 'Will Leszczuk'
 
-import os, logging, commands, pwd
+import os, sys, logging, logging.handlers, commands, pwd, threading, Queue
+import time, json, fcntl
+from collections import deque, OrderedDict
+from evolve.shared.instrument import span
 
 _logs = { }
+_user = { 'uid': None }
+
+def set_user(uid):
+  '''
+    Sets the uid on whose behalf evolve is acting, for logging and metadata.
+    Defaults to the real uid of the process; evolved sets it per request.
+  '''
+  _user['uid'] = uid
+
+def get_user():
+  uid = coalesce(_user['uid'], os.getuid())
+  return pwd.getpwuid(uid).pw_name, uid
+
+class _UserAdapter(logging.LoggerAdapter):
+  def process(self, msg, kwargs):
+    kwargs['extra'] = dict(
+      kwargs.get('extra') or { }, user='%s/%d' % get_user()
+    )
+    return msg, kwargs
+
+class _JsonFormatter(logging.Formatter):
+  '''
+    Formats each record as a line of JSON. A dict passed as the `fields'
+    extra is added to the line after the message.
+  '''
+
+  def format(self, record):
+    entry = OrderedDict([
+      ('time', '%s.%03d' % (
+        time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)),
+        record.msecs
+      )),
+      ('pid', record.process),
+      ('user', getattr(record, 'user', None)),
+      ('level', record.levelname),
+      ('message', record.getMessage()),
+    ])
+    entry.update(getattr(record, 'fields', None) or { })
+    if record.exc_info and not record.exc_text:
+      record.exc_text = self.formatException(record.exc_info)
+    if record.exc_text: entry['exception'] = record.exc_text
+    try: return json.dumps(entry, default=str)
+    except UnicodeDecodeError:
+      return json.dumps(entry, default=str, encoding='latin-1')
+
+class _RotatingFileHandler(logging.handlers.RotatingFileHandler):
+  '''
+    Rolls the log over once it reaches MaxBytes, or when it was last written
+    in an earlier Interval (a day) than the current one, keeping Backups of
+    the old ones. Other processes write the same logs, so the rollover is
+    made under a lock, and only by whichever of them gets there first; the
+    rest reopen the log when they find it moved.
+  '''
+  MaxBytes = 16 * 1024 * 1024
+  Interval = 24 * 60 * 60
+  Backups = 7
+
+  def __init__(self, path):
+    logging.handlers.RotatingFileHandler.__init__(
+      self, path, maxBytes=_RotatingFileHandler.MaxBytes,
+      backupCount=_RotatingFileHandler.Backups, delay=True
+    )
+
+  def emit(self, record):
+    if not None is self.stream:
+      try:
+        moved = os.fstat(self.stream.fileno()).st_ino \
+          != os.stat(self.baseFilename).st_ino
+      except OSError: moved = True
+      if moved:
+        self.stream.close()
+        self.stream = None
+    logging.handlers.RotatingFileHandler.emit(self, record)
+
+  def shouldRollover(self, record):
+    try: stat = os.stat(self.baseFilename)
+    except OSError: return False
+    if 0 == stat.st_size: return False
+    interval = _RotatingFileHandler.Interval
+    return stat.st_size >= self.maxBytes \
+      or int(stat.st_mtime // interval) < int(time.time() // interval)
+
+  def doRollover(self):
+    with open(self.baseFilename + '.lock', 'a') as lockfile:
+      fcntl.flock(lockfile, fcntl.LOCK_EX)
+      if self.shouldRollover(None):
+        logging.handlers.RotatingFileHandler.doRollover(self)
+      elif not None is self.stream:
+        # rolled over by someone else while we waited
+        self.stream.close()
+        self.stream = None
+
+class _QueueHandler(logging.Handler):
+  '''
+    Hands records to a thread that writes them with the handler it wraps,
+    so that logging doesn't wait on the disk or on a rollover. Past
+    QueueSize records behind, records are dropped (and the number dropped
+    logged when it catches up). The queue is drained when the handler is
+    closed, which logging does at exit. A forked child starts a writer of
+    its own the first time it logs.
+  '''
+  QueueSize = 10000
+
+  def __init__(self, target):
+    logging.Handler.__init__(self)
+    self.target = target
+    self._start()
+
+  def _start(self):
+    self.pid = os.getpid()
+    self.queue = Queue.Queue(_QueueHandler.QueueSize)
+    self.dropped = 0
+    # the parent's writer may have held the target's lock as it forked
+    self.target.createLock()
+    self.thread = threading.Thread(target=self._write)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def emit(self, record):
+    if self.pid != os.getpid(): self._start()
+    try:
+      # formatted now, while the arguments still hold what they did
+      record.msg, record.args = record.getMessage(), None
+      if record.exc_info:
+        record.exc_text = self.target.formatter.formatException(
+          record.exc_info
+        )
+        record.exc_info = None
+      self.queue.put_nowait(record)
+    except Queue.Full:
+      self.dropped += 1
+    except Exception:
+      self.handleError(record)
+
+  def _write(self):
+    while True:
+      record = self.queue.get()
+      if None is record: return
+      dropped, self.dropped = self.dropped, 0
+      if dropped:
+        self.target.handle(logging.makeLogRecord({
+          'name': record.name, 'levelno': logging.WARNING,
+          'levelname': 'WARNING', 'msg': 'dropped [%d] log records' % dropped
+        }))
+      self.target.handle(record)
+
+  def close(self):
+    if self.thread.is_alive():
+      self.queue.put(None)
+      self.thread.join()
+    self.target.close()
+    logging.Handler.close(self)
 
-# TODO: rolling file appender
 def get_logger(path, level):
+  '''
+    Returns the logger writing to the file at path, as JSON lines that are
+    rolled over by size and age and written from a thread of their own.
+  '''
   name = path.replace('/', '-')
   if not name in _logs:
     if not os.path.exists(os.path.dirname(path)):
@@ -43,33 +201,16 @@ def get_logger(path, level):
 
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    filehandler = logging.FileHandler(path)
-    filehandler.setFormatter(
-      logging.Formatter(
-        '%(asctime)s - %(process)d - %(user)s - %(levelname)s - %(message)s'
-      )
-    )
-    logger.addHandler(filehandler)
+    filehandler = _RotatingFileHandler(path)
+    filehandler.setFormatter(_JsonFormatter())
+    logger.addHandler(_QueueHandler(filehandler))
 
-    logger = logging.LoggerAdapter(
-      logger,
-      { 'user': pwd.getpwuid(os.getuid()).pw_name + '/' + str(os.getuid()) }
-    )
+    logger = _UserAdapter(logger, { })
 
     _logs[name] = logger
 
   return _logs[name]
 
-def get_modules(package, files):
-  return [
-    (modname, __import__(package + modname))
-      for modname in [
-        os.path.basename(f[:-3]) 
-        for f in files
-        if f.endswith('.py') and not f.startswith('.')
-      ]
-  ]
-
 def columnize(prefix, widths, values, newline=True, sep=' ', suffix=''):
   values = [
     tuple([str(v) for v in valtuple])
@@ -137,6 +278,152 @@ def columnize_best_fit(
 
   columnize(prefix, largest, values, newline, sep, suffix)
 
+def format_bytes(count):
+  for unit in ['B', 'KB', 'MB', 'GB']:
+    if 1024 > count: break
+    count /= 1024.0
+  else:
+    unit = 'TB'
+  return ('%d %s' if 'B' == unit else '%.1f %s') % (count, unit)
+
+class ProgressLine(object):
+  '''
+    Reports the progress of a long-running operation on a line of stderr,
+    rewritten at most every Interval seconds.
+  '''
+  Interval = 0.5
+
+  def __init__(self):
+    self.last = 0
+
+  def write(self, text):
+    now = time.time()
+    if now - self.last < ProgressLine.Interval: return
+    self.last = now
+    sys.stderr.write('\r  %s   ' % text)
+
+  def sync_stats(self, stats):
+    # for the progress callbacks given SyncStats (install, push)
+    self.write('%d files, %s, %s/s' % (
+      stats.get_files(), format_bytes(stats.bytes),
+      format_bytes(stats.get_rate())
+    ))
+
+  def end(self):
+    sys.stderr.write('\n')
+
+class _Slot(object):
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+  def get(self):
+    while not self.done.wait(0.1): pass # a timeout keeps ^C deliverable
+    if not None is self.error:
+      type, value, traceback = self.error
+      raise type, value, traceback
+    return self.result
+
+def imap_parallel(fn, iterable, jobs, window=None):
+  '''
+    Like itertools.imap, but calls fn on up to `jobs' items at once from a
+    pool of worker threads. The input is consumed lazily, with at most
+    `window' items in flight, and results are yielded in input order. An
+    exception raised by fn is re-raised when its result is reached, after
+    which outstanding work is abandoned.
+  '''
+  if 1 >= jobs:
+    for item in iterable: yield fn(item)
+    return
+
+  tasks = Queue.Queue()
+  cancelled = threading.Event()
+
+  def _work():
+    while True:
+      task = tasks.get()
+      if None is task: return
+      slot, item = task
+      if not cancelled.is_set():
+        try: slot.result = fn(item)
+        except BaseException: slot.error = sys.exc_info()
+      slot.done.set()
+
+  workers = [threading.Thread(target=_work) for i in range(jobs)]
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+
+  pending = deque()
+  try:
+    for item in iterable:
+      slot = _Slot()
+      tasks.put((slot, item))
+      pending.append(slot)
+      if len(pending) >= (window or 4 * jobs): yield pending.popleft().get()
+    while pending: yield pending.popleft().get()
+  finally:
+    cancelled.set()
+    for worker in workers: tasks.put(None)
+    for worker in workers: worker.join()
+
+def iwalk_parallel(fn, root, jobs):
+  '''
+    Walks a tree depth first from root, where fn(node) returns a (result,
+    children) pair, yielding (node, result) in walk order. With more than one
+    job, fn is called from a pool of worker threads, each of which queues a
+    node's children as soon as it knows them, so the pool reads ahead of the
+    caller across the whole tree. An exception raised by fn is re-raised when
+    its node is reached, after which outstanding work is abandoned.
+  '''
+  if 1 >= jobs:
+    stack = [root]
+    while stack:
+      node = stack.pop()
+      result, children = fn(node)
+      yield node, result
+      stack.extend(reversed(children))
+    return
+
+  tasks = Queue.Queue()
+  cancelled = threading.Event()
+  slots = { }
+
+  def _submit(node):
+    slot = slots[node] = _Slot()
+    tasks.put((slot, node))
+
+  def _work():
+    while True:
+      task = tasks.get()
+      if None is task: return
+      slot, node = task
+      if not cancelled.is_set():
+        try:
+          slot.result = fn(node)
+          for child in slot.result[1]: _submit(child)
+        except BaseException: slot.error = sys.exc_info()
+      slot.done.set()
+
+  workers = [threading.Thread(target=_work) for i in range(jobs)]
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+
+  try:
+    _submit(root)
+    stack = [root]
+    while stack:
+      node = stack.pop()
+      result, children = slots.pop(node).get()
+      yield node, result
+      stack.extend(reversed(children))
+  finally:
+    cancelled.set()
+    for worker in workers: tasks.put(None)
+    for worker in workers: worker.join()
+
 def first(fn, *args):
   for a in args:
     if fn(a):
@@ -146,7 +433,8 @@ def coalesce(*args):
   return first(lambda arg: not None is arg, *args)
 
 def do_or_die(command):
-  success, output = commands.getstatusoutput(command)
+  with span('subprocess:' + command.split()[0], command=command):
+    success, output = commands.getstatusoutput(command)
   if 0 != success:
     raise Exception(
       'failed to execute command [%s]: result code = [%d]' % (command, success)